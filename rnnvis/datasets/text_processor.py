@@ -7,6 +7,22 @@ from collections import Counter
 from rnnvis.utils.io_utils import path_exists, lists2csv, save2text, text2list, csv2list, get_path
 
 
+# the universal tagset of nltk, the POS tags are recorded as their indices in this list
+pos_tag_list = ['ADJ', 'ADP', 'ADV', 'CONJ', 'DET', 'NOUN', 'NUM', 'PRT', 'PRON', 'VERB', '.', 'X']
+_pos_tag_codes = {tag: i for i, tag in enumerate(pos_tag_list)}
+
+
+def pos_tag_code(tag):
+    """
+    Convert a POS tag to its int code, unknown tags are coded as 'X'
+    :param tag: a str of the tag, or an int code which is returned as it is
+    :return: an int
+    """
+    if isinstance(tag, int):
+        return tag
+    return _pos_tag_codes.get(tag, _pos_tag_codes['X'])
+
+
 def lazy_property(func):
     attribute = '_' + func.__name__
 
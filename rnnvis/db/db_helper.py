@@ -234,13 +234,15 @@ def push_evaluation_records(eval_ids, records):
     return results, update_results
 
 
-def query_evaluation_records(eval_, range_=None, data_name=None, model_name=None):
+def query_evaluation_records(eval_, range_=None, data_name=None, model_name=None, fields=None):
     """
     Query for the evaluation records
     :param eval_: a eval_id of type ObjectId, or a list of tokens, or a hash tag of the tokens
     :param range_: a range object, specifying the range of indices of records
     :param data_name: optional, when `eval` is not a ObjectId, this field should be filled
     :param model_name: optional, when `eval` is not a ObjectId, this field should be filled
+    :param fields: optional, a list of record fields to fetch, e.g., ['word_id', 'state_c'],
+        if None, fetch all the fields. Skipping unused fields saves a lot of transferring and unpickling.
     :return: a list of records
     """
     if isinstance(eval_, ObjectId):
@@ -262,7 +264,7 @@ def query_evaluation_records(eval_, range_=None, data_name=None, model_name=None
     records = []
     range_ = range(len(ids)) if range_ is None else range_
     for i in range_:
-        record = db_hdlr['record'].find_one({'_id': ids[i]})
+        record = db_hdlr['record'].find_one({'_id': ids[i]}, fields)
         for name, value in record.items():
             if isinstance(value, bytes):
                 record[name] = pickle.loads(value)
@@ -277,6 +279,17 @@ def query_evals(data_name, model_name, set_name=None):
     return db_hdlr['eval'].find(filt)
 
 
+def query_eval_data(eval_ids):
+    """
+    Query for the word ids of a batch of evals
+    :param eval_ids: a list of eval ids, of type ObjectId or str
+    :return: a dict {eval_id: data}, keyed by the eval ids as given
+    """
+    object_ids = {ObjectId(eval_id) if isinstance(eval_id, str) else eval_id: eval_id for eval_id in eval_ids}
+    evals = db_hdlr['eval'].find({'_id': {'$in': list(object_ids.keys())}}, {'data': 1})
+    return {object_ids[eval_['_id']]: eval_['data'] for eval_ in evals}
+
+
 def delete_evals(eval_ids):
     if isinstance(eval_ids, ObjectId):
         eval_ids = [eval_ids]
@@ -5,8 +5,54 @@ Entry point of the app
 import sys
 import argparse
 
-from rnnvis.server import app
+import yaml
+
 from rnnvis.db import seed_db
+from rnnvis.utils.io_utils import get_path
+from rnnvis.state_processor import batch_projections, batch_salience
+
+
+def model_configs():
+    """
+    Iterate over the models in config/models.yml
+    :return: a generator of pairs (config_file, config), config is the 'model' section of the config file
+    """
+    with open(get_path('config', 'models.yml')) as f:
+        models = yaml.safe_load(f)
+    for model in models.values():
+        config_file = get_path('config/model', model['config'])
+        with open(config_file) as f:
+            yield config_file, yaml.safe_load(f)['model']
+
+
+def state_names(config):
+    """The names of the state fields recorded for a model config"""
+    return ['state_c', 'state_h'] if 'LSTM' in config.get('cell_type', 'BasicLSTM') else ['state']
+
+
+def projection_jobs(perplexities):
+    """
+    List the projection jobs of every layer and state of the models in config/models.yml
+    :param perplexities: a list of perplexities
+    :return: a list of tuples (data_name, model_name, state_name, layer, perplexity)
+    """
+    jobs = []
+    for _, config in model_configs():
+        for state_name in state_names(config):
+            for layer in range(len(config['cells'])):
+                for perplexity in perplexities:
+                    jobs.append((config['dataset'], config['name'], state_name, layer, perplexity))
+    return jobs
+
+
+def salience_jobs(top_k):
+    """
+    List the salience jobs of the models in config/models.yml
+    :param top_k: the number of the most frequent words to compute, bounded by the vocab size of each model
+    :return: a list of tuples (config_file, model_name, top_k)
+    """
+    return [(config_file, config['name'], min(top_k, config['vocab_size']))
+            for config_file, config in model_configs()]
 
 
 def main(args=None):
@@ -15,19 +61,37 @@ def main(args=None):
         args = sys.argv[1:]
 
     parser = argparse.ArgumentParser(description='Command Line Tools for running RNNVis')
-    parser.add_argument('method', choices=['server', 'seeddb'],
-                        help='sever to run the server, seeddb to initialize db from config files')
+    parser.add_argument('method', choices=['server', 'seeddb', 'precompute', 'salience'],
+                        help='sever to run the server, seeddb to initialize db from config files, '
+                             'precompute to fill the projection cache of all the models, '
+                             'salience to compute the salience of the frequent words of all the models')
     parser.add_argument('--debug', '-d', dest='debug', action='store_const', const=True, default=False,
                         help='set this flag to debug')
     parser.add_argument('--force', '-f', dest='force', action='store_const', const=True, default=False,
                         help='set this flag to force re-seed db')
+    parser.add_argument('--workers', '-w', dest='workers', type=int, default=None,
+                        help='the number of worker processes used by precompute and salience, '
+                             'default to the number of cpus')
+    parser.add_argument('--perplexity', '-p', dest='perplexity', type=float, nargs='+', default=[40.0],
+                        help='the perplexities of the projections to precompute')
+    parser.add_argument('--top_k', '-k', dest='top_k', type=int, default=1000,
+                        help='the number of the most frequent words whose salience are computed')
     args = parser.parse_args(args)
 
     if args.method == 'server':
+        from rnnvis.server import app  # lazy import, the app loads and restores all the models
         app.run(debug=args.debug, threaded=True)
     elif args.method == 'seeddb':
         seed_db(args.force)
         print("Seeding Done.")
+    elif args.method == 'precompute':
+        jobs = projection_jobs(args.perplexity)
+        errors = batch_projections(jobs, args.workers)
+        print("Precomputing Done. {:d} of {:d} jobs failed.".format(sum(e is not None for e in errors), len(jobs)))
+    elif args.method == 'salience':
+        for config_file, model_name, top_k in salience_jobs(args.top_k):
+            batch_salience(config_file, model_name, top_k, workers=args.workers)
+        print("Salience Done.")
 
 
 if __name__ == "__main__":
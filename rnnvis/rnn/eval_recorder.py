@@ -5,6 +5,7 @@ Recorders for Evaluator
 from collections import defaultdict
 
 from rnnvis.db.db_helper import insert_evaluation, push_evaluation_records
+from rnnvis.datasets.text_processor import pos_tag_code
 
 
 class Recorder(object):
@@ -96,7 +97,7 @@ class StateRecorder(Recorder):
             record['word_id'] = word_id
             if word_id >= 0:
                 if self.pos_tags is not None:
-                    record['pos'] = self.pos_tags[start_x + i][start_y]
+                    record['pos'] = pos_tag_code(self.pos_tags[start_x + i][start_y])
                 good_records.append(record)
                 eval_ids.append(self.eval_doc_id[start_x + i])
         self.buffer['records'] += good_records
@@ -168,107 +168,182 @@ class Evaluator(object):
         recorder.flush()
         print("Evaluation done!")
 
+    def _salience_tensors(self):
+        """
+        Collect the state and gate tensors whose salience are calculated
+        :return: a list of (name, layer_tensors) pairs, where the name is a field name like 'state_c' or 'gate_f'
+        """
+        tensors = defaultdict(list)
+        for state in self.model.final_state:
+            if isinstance(state, tf.nn.rnn_cell.LSTMStateTuple):
+                tensors['state_c'].append(state.c)
+                tensors['state_h'].append(state.h)
+            else:
+                tensors['state'].append(state)
+        gates = self.model.get_gate_tensor()
+        if gates is not None:
+            for gate in gates:
+                if isinstance(gate, tuple):  # LSTM gates are a tuple of (i, f, o)
+                    tensors['gate_i'].append(gate[0])
+                    tensors['gate_f'].append(gate[1])
+                    tensors['gate_o'].append(gate[2])
+                else:
+                    tensors['gate'].append(gate)
+        return list(tensors.items())
+
     def _cal_salience(self, sess, embedding=None, feed_dict=None, y_or_x=None):
         """
         Calculate the saliency matrix of states regarding inputs,
         this should be called on a trained model for evaluation
         (you can also call this on a just initialized one to compare)
         :param sess: the sess to run the computation
-        :param embedding: the word embedding to put into the computation of the gradients
+        :param embedding: a batch of word ids of length batch_size,
+            or the word embeddings of shape [batch_size, 1, embedding_size] to compute the gradients at,
+            if None, compute the gradients at zero inputs
         :param feed_dict: extra feed_dict, should feed in the states
-        :return:
+        :param y_or_x: see docs of cal_jacobian
+        :return: a dict {name: [salience of layer_0, ...]}, each salience is of shape [batch_size, ...]
         """
         salience = defaultdict(list)
         inputs = self.model.inputs
         if feed_dict is None:
             self.model.init_state(sess)
             feed_dict = self.model.feed_state(self.model.current_state)
-        if isinstance(embedding, int):
-            embedding = sess.run(inputs, {self.model.input_holders: np.array([embedding]).reshape(1, 1)})
-        with sess.as_default():
-            for state in self.model.final_state:
-                if isinstance(state, tf.nn.rnn_cell.LSTMStateTuple):
-                    salience['state_c'].append(cal_jacobian(state.c, inputs, embedding, feed_dict, y_or_x))
-                    salience['state_h'].append(cal_jacobian(state.h, inputs, embedding, feed_dict, y_or_x))
-                else:
-                    salience['state'].append(cal_jacobian(state, inputs, embedding, feed_dict, y_or_x))
-            gates = self.model.get_gate_tensor()
-            if gates is None:
-                return salience
-            for gate in gates:
-                if isinstance(gate, tuple):  # LSTM gates are a tuple of (i, f, o)
-                    salience['gate_i'].append(cal_jacobian(gate[0], inputs, embedding, feed_dict, y_or_x))
-                    salience['gate_f'].append(cal_jacobian(gate[1], inputs, embedding, feed_dict, y_or_x))
-                    salience['gate_o'].append(cal_jacobian(gate[2], inputs, embedding, feed_dict, y_or_x))
-                else:
-                    salience['gate'].append(cal_jacobian(gate, inputs, embedding, feed_dict, y_or_x))
-
+        if embedding is None:
+            embedding = np.zeros(inputs.get_shape().as_list(), inputs.dtype.as_numpy_dtype)
+        elif not isinstance(embedding, np.ndarray) or embedding.dtype.kind in 'iu':
+            ids = np.array(embedding).reshape(self.model.batch_size, 1)
+            embedding = sess.run(inputs, {self.model.input_holders: ids})
+        ops = {}
+        for name, tensors in self._salience_tensors():
+            pairs = [jacobian_op(tensor, inputs, y_or_x) for tensor in tensors]
+            if any(cotangent is not None for _, cotangent in pairs):
+                # the Jacobian is computed row by row, one run per output dimension, evaluate the tensors one by one
+                with sess.as_default():
+                    salience[name] = [cal_jacobian(tensor, inputs, embedding, feed_dict, y_or_x)
+                                      for tensor in tensors]
+            else:
+                ops[name] = [op for op, _ in pairs]
+        if ops:
+            # the reduced salience of a tensor is a single gradient op, run them all at once
+            feed_dict = dict(feed_dict)
+            feed_dict[inputs] = embedding
+            for name, values in sess.run(ops, feed_dict).items():
+                salience[name] = [value.reshape(self.model.batch_size, -1) for value in values]
         return salience
 
     def cal_salience(self, sess, word_ids, feed_dict=None, y_or_x=None, verbose=True):
         """
         This function calculate the salience of states and gates w.r.t. given words.
-        The method used will not add any new TF ops, feel free to finalize the graph before calling this function
-        Note: this function is very time consuming. About 5s per word on a laptop
+        The gradients are computed by back-propagation on batches of words (of the batch_size of the evaluator).
+        The gradient ops are added to the graph at the first call, so do not finalize the graph before that.
         :param sess: the session to run the computation
         :param word_ids: the word_ids as a list
         :param feed_dict: additional feed_dict to feed in the sess.run()
-        :param y_or_x: see docs of cal_gradients
+        :param y_or_x: see docs of cal_jacobian
         :param verbose: print progress
-        :return: a list of salience
+        :return: a list of salience, one for each word
         """
         if isinstance(word_ids, int):
             word_ids = [word_ids]
         elif not isinstance(word_ids, list):
             raise TypeError("word_ids should be of type int of a list of int, but it's of type: {:s}"
                             .format(str(type(word_ids))))
+        batch_size = self.model.batch_size
         saliences = []
-        for i, word in enumerate(word_ids):
-            saliences.append(self._cal_salience(sess, word, feed_dict, y_or_x))
-            if (i+1) % 20 == 0 and verbose:
-                print("{:d}/{:d} completed".format(i+1, len(word_ids)))
-        print("salience computation finished.")
+        for i in range(0, len(word_ids), batch_size):
+            batch = word_ids[i:i+batch_size]
+            # pad the last batch with its last word
+            padded = batch + [batch[-1]] * (batch_size - len(batch))
+            salience = self._cal_salience(sess, padded, feed_dict, y_or_x)
+            for j in range(len(batch)):
+                saliences.append({name: [value[j] for value in values] for name, values in salience.items()})
+            if verbose and (i // batch_size + 1) % 20 == 0:
+                print("{:d}/{:d} completed".format(len(saliences), len(word_ids)))
+        if verbose:
+            print("salience computation finished.")
         return saliences
 
 
+# the gradient ops built by jacobian_op, keyed by (y, x, y_or_x), so that they are only added to the graph once
+_jacobian_ops = {}
+
+
+def jacobian_op(y, x, y_or_x=None):
+    """
+    Build (or get the built) TF ops that calculate the Jacobian Matrix of y w.r.t. x by back-propagation.
+    The first dimension of y and x is the batch dimension, and the rows of a batch should be computed independently
+    (which holds for the states and gates of a RNN), so that the Jacobian of a batch of inputs is computed at once.
+    :param y: a tensor of shape [batch_size, ...]
+    :param x: a tensor of shape [batch_size, ...]
+    :param y_or_x: see docs of cal_jacobian
+    :return: a pair (op, cotangent). If cotangent is not None, it is a placeholder of the shape of y,
+        and op computes the vector-Jacobian product cotangent * jacobian, i.e. feeding in one-hot cotangents
+        gives the rows of the Jacobian, this is the case when y_or_x is None, or when y_or_x is 'y'
+        but the second order gradients of the ops in y are not available.
+        Otherwise, op computes the reduced salience.
+    """
+    key = (y, x, y_or_x)
+    if key in _jacobian_ops:
+        return _jacobian_ops[key]
+    if y_or_x not in (None, 'x', 'y'):
+        raise ValueError("y_or_x should be None, 'x' or 'y', but got {:s}".format(str(y_or_x)))
+    op, cotangent = None, None
+    with y.graph.as_default():
+        if y_or_x == 'x':  # ones(y_len) * jacobian => shape: [x_len,]
+            op = tf.gradients(y, x)[0]
+        elif y_or_x == 'y':  # jacobian * ones(x_len) => shape: [y_len,]
+            # v * jacobian is linear in v, so its gradient w.r.t. v along ones(x_len) is jacobian * ones(x_len)
+            v = tf.zeros_like(y)
+            vjp = tf.gradients(y, x, grad_ys=v)[0]
+            try:
+                op = tf.gradients(vjp, v, grad_ys=tf.ones_like(vjp))[0]
+            except LookupError:
+                # no gradients registered for some gradient ops (e.g., SigmoidGrad), compute the rows instead
+                print("WARN: second order gradients of {:s} are not available, fall back to the rows of the Jacobian"
+                      .format(y.name))
+        if op is None:
+            cotangent = tf.placeholder(y.dtype, y.get_shape())
+            op = tf.gradients(y, x, grad_ys=cotangent)[0]
+    _jacobian_ops[key] = op, cotangent
+    return op, cotangent
+
+
 def cal_jacobian(y, x, x_val=None, feed_dict=None, y_or_x=None):
     """
-    A numerical way of calculating the Jacobian Matrix of y w.r.t to x
-    :param y:
-    :param x:
-    :param x_val:
-    :param feed_dict:
-    :param y_or_x: if None, do not do any projection, directly return the Jacobian matrix,
-        if 'y', return a 1-D vector of length y_len, which is the sum(dy/dx) over x
-        if 'x', return a 1-D vector of length x_len, which is the sum(dy/dx) over y
-    :return:
+    Calculate the Jacobian Matrix of y w.r.t to x for a batch of inputs, using the gradient ops of jacobian_op
+    :param y: a tensor of shape [batch_size, ...]
+    :param x: a tensor of shape [batch_size, ...]
+    :param x_val: the value of x, default to zeros
+    :param feed_dict: extra feed_dict
+    :param y_or_x: if None, do not do any projection, directly return the Jacobian matrix of shape
+            [batch_size, y_len, x_len],
+        if 'y', return vectors of shape [batch_size, y_len], which is the sum(dy/dx) over x
+        if 'x', return vectors of shape [batch_size, x_len], which is the sum(dy/dx) over y
+    :return: a numpy array
     """
-    delta = 1e-7
+    op, cotangent = jacobian_op(y, x, y_or_x)
     x_shape = x.get_shape().as_list()
-    x_len = reduce(lambda a, b: a*b, x_shape)
+    batch_size = x_shape[0]
     if x_val is None:
-        x_val = np.zeros((x_len, ), x.dtype.as_numpy.dtype)
-    else:
-        x_val = x_val.reshape((x_len, ))
-    if feed_dict is None:
-        feed_dict = {}
-
-    _jacobian = []
-    for i in range(x_len):
-        input_x = x_val.copy()
-
-        input_x[i] += delta
-        feed_dict[x] = input_x.reshape(x_shape)
-        y_val1 = y.eval(feed_dict, tf.get_default_session()).reshape(-1)
-        input_x[i] -= 2*delta
-        feed_dict[x] = input_x.reshape(x_shape)
-        y_val2 = y.eval(feed_dict, tf.get_default_session()).reshape(-1)
-        _jacobian.append((y_val1 - y_val2))
+        x_val = np.zeros(x_shape, x.dtype.as_numpy_dtype)
+    feed_dict = {} if feed_dict is None else dict(feed_dict)
+    feed_dict[x] = x_val.reshape(x_shape)
+    sess = tf.get_default_session()
+    if cotangent is None:
+        return sess.run(op, feed_dict).reshape(batch_size, -1)
 
-    jacobian = (np.stack(_jacobian) / (2*delta)).T  # a correct jacobian should has shape [y_len, x_len]
-    if y_or_x is None:
-        return jacobian
-    elif y_or_x is 'x':  # ones(y_len) * jacobian => shape: [x_len,]
-        return np.sum(jacobian, axis=0)
-    elif y_or_x is 'y':  # jacobian * ones(x_len) => shape: [y_len,]
+    y_shape = y.get_shape().as_list()
+    y_len = reduce(lambda a, b: a*b, y_shape[1:], 1)
+    rows = []
+    for i in range(y_len):
+        one_hot = np.zeros((batch_size, y_len), y.dtype.as_numpy_dtype)
+        one_hot[:, i] = 1
+        feed_dict[cotangent] = one_hot.reshape(y_shape)
+        rows.append(sess.run(op, feed_dict).reshape(batch_size, -1))
+    jacobian = np.stack(rows, axis=1)  # a correct jacobian should has shape [batch_size, y_len, x_len]
+    if y_or_x == 'y':
+        return np.sum(jacobian, axis=2)
+    if y_or_x == 'x':
         return np.sum(jacobian, axis=1)
+    return jacobian
@@ -337,6 +337,8 @@ class RNN(object):
         self._sess = None
         self._saver = None
         self._init_op = None
+        self._checkpoint = None
+        self._weights = {}  # the weights read from the session, which are reset when the variables are restored
         self.models = []
         self.graph = graph if isinstance(graph, tf.Graph) else tf.get_default_graph()
         self.logdir = logdir or get_path('./models', name)
@@ -631,6 +633,7 @@ class RNN(object):
         # with self.sess as sess:
         #     self.supervisor.saver.save(sess, path, global_step=self.supervisor.global_step)
         self._saver.save(self.sess, path)
+        self._weights = {}
         print("Model variables saved to {}.".format(get_path(path, absolute=True)))
 
     def restore(self, path=None):
@@ -641,6 +644,8 @@ class RNN(object):
         # print(path)
         # print(checkpoint)
         self._saver.restore(self.sess, checkpoint)
+        self._checkpoint = checkpoint
+        self._weights = {}
         # with self.supervisor.managed_session() as sess:
         #     self.supervisor.saver.restore(sess, checkpoint)
         print("Model variables restored from {}.".format(get_path(path, absolute=True)))
@@ -661,6 +666,11 @@ class RNN(object):
         # self.supervisor = tf.train.Supervisor(self.graph, logdir=self.logdir)
         return True
 
+    @property
+    def checkpoint(self):
+        """The path of the last restored checkpoint, None if the model is not restored"""
+        return self._checkpoint
+
     @property
     def finalized(self):
         # return False if self.supervisor is None else True
@@ -731,7 +741,9 @@ class RNN(object):
                         return embedding.eval(sess)
 
         if self.has_embedding:
-            return self.run_with_context(get_embedding)
+            if 'embedding' not in self._weights:
+                self._weights['embedding'] = self.run_with_context(get_embedding)
+            return self._weights['embedding']
         else:
             return None
 
@@ -746,7 +758,9 @@ class RNN(object):
                 projcet_b = tf.get_variable("project_b", [target_size], dtype=data_type())
                 return sess.run([project_w, projcet_b])
         if self.has_project:
-            return self.run_with_context(get_project)
+            if 'project' not in self._weights:
+                self._weights['project'] = self.run_with_context(get_project)
+            return self._weights['project']
         return None
 
     def project_output(self, outputs):
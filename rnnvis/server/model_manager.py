@@ -4,7 +4,9 @@ The backend manager for handling the models
 
 import hashlib
 import os
+import threading
 import yaml
+import numpy as np
 from functools import lru_cache
 from _thread import start_new_thread
 
@@ -13,12 +15,16 @@ from rnnvis.rnn.rnn import RNN
 from rnnvis.rnn.evaluator import Evaluator
 from rnnvis.datasets.data_utils import Feeder, SentenceProducer
 from rnnvis.utils.io_utils import get_path, assert_path_exists
+from rnnvis.utils.cache import memory_cache, memory_cached
 from rnnvis.procedures import build_model, pour_data
 from rnnvis.rnn.eval_recorder import BufferRecorder, StateRecorder
 from rnnvis.state_processor import get_state_signature, get_empirical_strength, strength2json, \
-    get_tsne_projection, solution2json, get_co_cluster, get_state_statistics, get_pos_statistics, \
-    get_an_empirical_strength
-from rnnvis.datasets.text_processor import tokenize
+    get_tsne_projection, solution2json, solution2points, get_co_cluster, get_state_statistics, get_pos_statistics, \
+    get_co_clusters, get_an_empirical_strength, get_mds_projection, get_weights_projection, get_unit_contexts, \
+    get_unit_histograms, search_similar_states, get_unit_similarity, \
+    get_gate_statistics, get_bigram_statistics, get_sentiment_trajectories, get_comparative_statistics, get_salience, \
+    resolve_tsne_init
+from rnnvis.datasets.text_processor import tokenize, pos_tag_list
 from rnnvis.db.db_helper import query_evals
 
 _config_dir = 'config/model'
@@ -26,6 +32,45 @@ _data_dir = 'cached_data'
 _model_dir = 'models'
 
 
+class ProjectionJob(object):
+    """
+    A projection running in a background thread, which exposes its intermediate solutions while optimizing
+    """
+
+    def __init__(self, cal_fn, max_iter=1000):
+        """
+        :param cal_fn: a function called as cal_fn(callback) that returns the final solution,
+            where callback(iteration, solution, cost) should be called with intermediate solutions
+        :param max_iter: the total iterations, for reporting the progress
+        """
+        self.cal_fn = cal_fn
+        self.max_iter = max_iter
+        self.status = 'un-started'
+        self.iter = 0
+        self.cost = None
+        self.solution = None
+        self.error = None
+
+    def update(self, iteration, solution, cost):
+        self.solution = solution.copy()
+        self.iter = iteration
+        self.cost = cost
+
+    def start(self):
+        self.status = 'started'
+        start_new_thread(self._run, ())
+
+    def _run(self):
+        try:
+            self.solution = self.cal_fn(self.update)
+            self.iter = self.max_iter
+            self.status = 'done'
+        except Exception as e:
+            print("ERROR: Projection job failed: {:s}".format(str(e)))
+            self.error = str(e)
+            self.status = 'failed'
+
+
 class ModelManager(object):
 
     def __init__(self):
@@ -37,6 +82,8 @@ class ModelManager(object):
         self._models = {}
         self._train_configs = {}
         self.record_flag = {}
+        self._projection_jobs = {}
+        self._jobs_lock = threading.Lock()
         print("loading models...")
         for model_name in self._available_models.keys():
             try:
@@ -223,24 +270,98 @@ class ModelManager(object):
         word_list = id_to_word[:top_k]
         return strength2json(strength_mat, word_list)
 
-    def model_state_projection(self, name, state_name, layer=-1, method='tsne'):
+    def model_state_projection(self, name, state_name, layer=-1, method='tsne', perplexity=40.0):
         model = self._get_model(name)
         if model is None:
             return None
         config = self._train_configs[name]
         layer_num = len(model.cell_list)
         if method == 'tsne':
-            tsne_solution = get_tsne_projection(config.dataset, model.name, state_name, layer, 5000, 50, 40.0)
-            labels = [layer_num - 1 if layer < 0 else layer] * tsne_solution.shape[0]
+            # warm start from the layout of another perplexity if any, which keeps the layouts stable
+            solution = get_tsne_projection(config.dataset, model.name, state_name, layer, 5000, 50, perplexity,
+                                           init='auto')
+        elif method == 'mds':
+            solution = get_mds_projection(config.dataset, model.name, state_name, layer, 5000, 50)
+        else:
+            return None
+        labels = [layer_num - 1 if layer < 0 else layer] * solution.shape[0]
+        states_num = [0] * layer_num
+        states_num[layer] = solution.shape[0]
+        return solution2json(solution, states_num, labels)
+
+    def model_projection_progress(self, name, state_name, layer=-1, method='tsne', perplexity=40.0):
+        """
+        Start a projection job in the background if not started, and return its current progress,
+        the final solution is stored in the same cache as model_state_projection once the job is done.
+        :return: a dict {'status', 'iter', 'max_iter', 'points'}, 'points' is absent until the first solution,
+            None if the model is not found or the method is not supported
+        """
+        model = self._get_model(name)
+        if model is None or method != 'tsne':
+            return None
+        config = self._train_configs[name]
+        layer_num = len(model.cell_list)
+        key = (name, state_name, layer, method, perplexity)
+        with self._jobs_lock:
+            job = self._projection_jobs.get(key)
+            if job is None or job.status == 'failed':
+                # resolve the warm start first, so that the job reports the iterations it really runs
+                init, max_iter = resolve_tsne_init(config.dataset, model.name, state_name, layer, 50, perplexity,
+                                                   'auto')
+                job = ProjectionJob(lambda callback: get_tsne_projection(config.dataset, model.name, state_name, layer,
+                                                                         5000, 50, perplexity, callback=callback,
+                                                                         init=init, max_iter=max_iter),
+                                    max_iter)
+                self._projection_jobs[key] = job
+                job.start()
+        progress = {'status': job.status, 'iter': job.iter, 'max_iter': job.max_iter}
+        solution = job.solution
+        if solution is not None:
             states_num = [0] * layer_num
-            states_num[layer] = tsne_solution.shape[0]
-            return solution2json(tsne_solution, states_num, labels)
+            states_num[layer] = solution.shape[0]
+            progress['points'] = solution2points(solution, states_num, [layer_num - 1 if layer < 0 else layer] *
+                                                 solution.shape[0])
+        if job.error is not None:
+            progress['error'] = job.error
+        return progress
+
+    def model_weights_projection(self, name, weights_name='embedding', top_k=None, method='mds', perplexity=40.0):
+        """
+        Project the embedding or the output projection weights of each word of a model
+        :param name: the name of the model
+        :param weights_name: 'embedding' or 'project'
+        :param top_k: only project the top_k frequent words, None for the whole vocabulary
+        :param method: 'mds' or 'tsne', see get_weights_projection
+        :return: a list of points {'coords', 'word_id', 'word'},
+            None if the model is not found or has no such weights
+        """
+        model = self._get_model(name)
+        if model is None:
+            return None
+        if weights_name == 'embedding' and model.has_embedding:
+            weights = lambda: model.embedding_weights
+        elif weights_name == 'project' and model.has_project:
+            weights = lambda: model.project_weights[0].T
         else:
             return None
+        checkpoint = model.checkpoint or ''
+        index_file = checkpoint + '.index'
+        mtime = os.path.getmtime(index_file) if os.path.exists(index_file) else 0
+        checkpoint_tag = hash_tag_str([checkpoint, str(mtime)])[:8]
+        solution = get_weights_projection(model.name, weights_name, weights, checkpoint_tag, top_k, method,
+                                          perplexity)
+        words = model.id_to_word
+        return [{'coords': coords, 'word_id': i, 'word': words[i] if i < len(words) else ''}
+                for i, coords in enumerate(solution.tolist())]
 
-    @lru_cache(maxsize=32)
     def model_co_cluster(self, name, state_name, n_cluster=2, layer=-1, top_k=100,
                          mode='positive', seed=0, method='cocluster'):
+        """
+        Co-cluster the words and units, see get_co_cluster
+        :return: a tuple (strength_mat, row_cluster, col_cluster, word_ids, words), None if the model is not found,
+            strength_mat is None if top_k is None, since the strength matrix of the whole vocabulary is too large
+            to be serialized
+        """
         model = self._get_model(name)
         if model is None:
             return None
@@ -250,7 +371,25 @@ class ModelManager(object):
                                  mode=mode, seed=seed, method=method)
         strength_mat, row_cluster, col_cluster, word_ids = results
         words = model.get_word_from_id(word_ids)
-        return strength_mat.tolist(), row_cluster.tolist(), col_cluster.tolist(), word_ids, words
+        strength_mat = None if top_k is None else strength_mat.tolist()
+        return strength_mat, row_cluster.tolist(), col_cluster.tolist(), word_ids, words
+
+    def model_co_clusters(self, name, state_name, n_clusters_list, layer=-1, top_k=100, mode='positive',
+                          seeds=(0,)):
+        """
+        Co-cluster the words and units with a batch of n_clusters and seeds in parallel, see get_co_clusters
+        :return: a tuple (strength_mat, word_ids, words, clusterings),
+            clusterings is a list of dicts {'n_cluster', 'seed', 'row', 'col'}, None if the model is not found
+        """
+        model = self._get_model(name)
+        if model is None:
+            return None
+        config = self._train_configs[name]
+        strength_mat, word_ids, labels = get_co_clusters(config.dataset, model.name, state_name, n_clusters_list,
+                                                         layer, top_k, mode, seeds)
+        clusterings = [{'n_cluster': n_clusters, 'seed': seed, 'row': row_labels.tolist(), 'col': col_labels.tolist()}
+                       for (n_clusters, seed), (row_labels, col_labels) in labels.items()]
+        return strength_mat.tolist(), word_ids, model.get_word_from_id(word_ids), clusterings
 
     def model_vocab(self, name, top_k=None):
         model = self._get_model(name)
@@ -260,7 +399,6 @@ class ModelManager(object):
             return model.id_to_word
         return model.id_to_word[:top_k]
 
-    @lru_cache(maxsize=32)
     def state_statistics(self, name, state_name, diff=True, layer=-1, top_k=500, k=None):
         model = self._get_model(name)
         if model is None:
@@ -271,16 +409,157 @@ class ModelManager(object):
         stats = get_state_statistics(config.dataset, model.name, state_name, diff, layer, top_k, k)
         return stats
 
-    @lru_cache(maxsize=32)
+    def similar_states(self, name, state_name, layer, state, k=10, window=5):
+        """
+        Search the recorded states most similar to the given state, see state_processor.search_similar_states
+        :return: a list of contexts of the similar states, with the words of the contexts added as 'words'
+        """
+        model = self._get_model(name)
+        if model is None:
+            return None
+        config = self._train_configs[name]
+        contexts = search_similar_states(config.dataset, model.name, state_name, layer, state, k, window=window)
+        for context in contexts:
+            context['words'] = model.get_word_from_id(context['context'])
+        return contexts
+
+    def comparative_statistics(self, names, state_name, layer=-1, top_k=100, diff=True):
+        """
+        Get the state statistics of several models on the same dataset, aligned by words
+        :param names: a list of model names, the models should be trained on the same dataset
+        :return: a dict {'ids', 'freqs', 'words', 'models'}, 'models' is a dict {name: stats},
+            None if any model is not found
+        """
+        models = [self._get_model(name) for name in names]
+        if any(model is None for model in models):
+            return None
+        datasets = {self._train_configs[name].dataset for name in names}
+        if len(datasets) != 1:
+            raise ValueError("The models should be trained on the same dataset, but got {:s}"
+                             .format(', '.join(datasets)))
+        results = get_comparative_statistics(datasets.pop(), [model.name for model in models], state_name, diff,
+                                             layer, top_k)
+        return {'ids': results['ids'].tolist(), 'freqs': results['freqs'].tolist(),
+                'words': models[0].get_word_from_id(results['ids'].tolist()),
+                'models': {name: {key: value.tolist() for key, value in results['models'][model.name].items()}
+                           for name, model in zip(names, models)}}
+
+    def bigram_statistics(self, name, state_name, layer=-1, top_k=200, word=None, diff=True):
+        """
+        Get the state statistics regarding the most frequent (previous word, word) pairs
+        :param word: if given, only return the pairs that end with this word
+        :return: a dict of lists, with 'pairs' of ids and 'words' of the pairs, see get_bigram_statistics
+        """
+        model = self._get_model(name)
+        if model is None:
+            return None
+        config = self._train_configs[name]
+        stats = get_bigram_statistics(config.dataset, model.name, state_name, diff, layer)
+        selected = np.arange(len(stats['pairs']))
+        if word is not None:
+            word_id = model.get_id_from_word(word.lower())[0]
+            selected = selected[stats['pairs'][:, 1] == word_id]
+        selected = selected[:top_k]
+        results = {key: value[selected].tolist() for key, value in stats.items()}
+        results['words'] = [model.get_word_from_id(pair) for pair in results['pairs']]
+        return results
+
+    def sentiment_trajectories(self, name, state_name, layer=-1, n_buckets=10):
+        """
+        Get the mean states of the reviews by (label, relative position bucket), see get_sentiment_trajectories
+        :return: a dict of nested lists, None if the model is not found or is not a sentiment model
+        """
+        model = self._get_model(name)
+        if model is None or not model.use_last_output:
+            return None
+        config = self._train_configs[name]
+        output_field = 'state_h' if state_name in ['state_c', 'state_h'] else 'state'
+        results = get_sentiment_trajectories(config.dataset, model.name, state_name, layer, n_buckets,
+                                             model.project_weights, output_field)
+        return {kind: value if kind == 'accuracy' else {key: array.tolist() for key, array in value.items()}
+                for kind, value in results.items()}
+
+    def gate_statistics(self, name, gate_name, layer=-1, top_k=500):
+        model = self._get_model(name)
+        if model is None:
+            return None
+        config = self._train_configs[name]
+        return get_gate_statistics(config.dataset, model.name, gate_name, layer, top_k)
+
+    def unit_similarity(self, name, state_name, layers=-1, metric='correlation', diff=True):
+        """
+        Get the similarity matrix of the units of the layers, see state_processor.get_unit_similarity
+        """
+        model = self._get_model(name)
+        if model is None:
+            return None
+        config = self._train_configs[name]
+        return get_unit_similarity(config.dataset, model.name, state_name, layers, metric, diff).tolist()
+
+    def unit_histograms(self, name, state_name, layer=-1, unit=None, diff=True):
+        """
+        Get the histograms of the units of a layer, see state_processor.get_unit_histograms
+        :param unit: the index of a unit, if None, return the histograms of all the units in the layer
+        :return: a dict {'edges', 'counts'}, 'counts' is a list of n_units histograms, or one histogram of the unit
+        """
+        model = self._get_model(name)
+        if model is None:
+            return None
+        config = self._train_configs[name]
+        histograms = get_unit_histograms(config.dataset, model.name, state_name, diff)
+        counts = histograms['counts'][layer] if unit is None else histograms['counts'][layer, unit]
+        return {'edges': histograms['edges'].tolist(), 'counts': counts.tolist()}
+
+    def unit_contexts(self, name, state_name, layer, unit, k=10, window=5, diff=False):
+        """
+        Get the contexts that activate a unit most, see state_processor.get_unit_contexts
+        :return: a dict {'positive': contexts, 'negative': contexts}, the words of the contexts are added as 'words'
+        """
+        model = self._get_model(name)
+        if model is None:
+            return None
+        config = self._train_configs[name]
+        results = get_unit_contexts(config.dataset, model.name, state_name, layer, unit, k, window, diff)
+        for contexts in results.values():
+            for context in contexts:
+                context['words'] = model.get_word_from_id(context['context'])
+        return results
+
+    def word_salience(self, name, word, y_or_x='y'):
+        """
+        Get the salience of the states and gates w.r.t. a word from the store precomputed by
+            state_processor.batch_salience (run `python -m rnnvis.main salience`)
+        :param word: a word
+        :return: a dict {'word', 'word_id', 'salience'}, 'salience' is a dict {field_name: [vector of each layer]},
+            None if the model is not found, or the salience of the word is not precomputed
+        """
+        model = self._get_model(name)
+        if model is None:
+            return None
+        word_id = model.get_id_from_word(word.lower())[0]
+        # any store that covers the word
+        salience = get_salience(model.name, y_or_x, word_id + 1)
+        if salience is None:
+            return None
+        if salience['checkpoint'] != model.checkpoint:
+            print("WARN: the salience of {:s} is computed from checkpoint {:s}, which is not the restored one"
+                  .format(name, str(salience['checkpoint'])))
+        return {'word': model.get_word_from_id([word_id])[0], 'word_id': word_id,
+                'salience': {field: [layer[word_id].tolist() for layer in layers]
+                             for field, layers in salience['fields'].items()}}
+
+    @memory_cached
     def model_pos_statistics(self, name, top_k=500):
         model = self._get_model(name)
         if model is None:
             return None
         config = self._train_configs[name]
-        results = get_pos_statistics(config.dataset, model.name, top_k)
-        for pos_data in results:
-            word = model.id_to_word[pos_data['id']]
-            pos_data['word'] = word
+        ratios = get_pos_statistics(config.dataset, model.name)
+        seen = np.nonzero(np.sum(ratios, axis=1))[0][:top_k]
+        results = []
+        for i in seen.tolist():
+            ratio = {pos_tag_list[j]: ratios[i, j] for j in np.nonzero(ratios[i])[0].tolist()}
+            results.append({'id': i, 'ratio': ratio, 'word': model.id_to_word[i]})
         return results
 
     def model_empirical_strength_of_word(self, name, state_name, layer, word):
@@ -295,6 +574,22 @@ class ModelManager(object):
             strength = get_an_empirical_strength(config.dataset, model.name, state_name, layer, k)
         return strength.tolist()
 
+    def cache_stats(self):
+        return memory_cache.stats()
+
+    def purge_cache(self, name=None):
+        """
+        Purge the in-memory cached results
+        :param name: the name of the model, if None, purge all the cached results
+        :return: the number of purged entries
+        """
+        if name is None:
+            return memory_cache.purge()
+        model = self._get_model(name)
+        if model is None:
+            return None
+        return memory_cache.purge(arg=name) + memory_cache.purge(arg=model.name)
+
 
 def hash_tag_str(text_list):
     """Use hashlib.md5 to tag a hash str of a list of text"""
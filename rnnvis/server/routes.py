@@ -96,6 +96,24 @@ def model_evaluate():
     return "Not Found", 404
 
 
+@app.route('/state_neighbors', methods=['POST'])
+def state_neighbors():
+    """
+    Find the recorded states most similar to a state, e.g., a record returned by /models/evaluate,
+    the body should be a json {'model', 'state', 'layer', 'vector', 'k'}, where vector is the state of the layer
+    """
+    data = request.json
+    model = data['model']
+    state_name = data['state']
+    layer = int(data.get('layer', -1))
+    k = int(data.get('k', 10))
+    window = int(data.get('window', 5))
+    results = _manager.similar_states(model, state_name, layer, data['vector'], k, window)
+    if results is None:
+        return 'Cannot find model with name {:s}'.format(model), 404
+    return jsonify(results)
+
+
 @app.route('/models/config/<string:model>')
 @lru_cache(maxsize=8)
 def model_config(model):
@@ -146,8 +164,9 @@ def state_projection():
     state_name = request.args.get('state', '')
     layer = int(request.args.get('layer', -1))
     method = request.args.get('method', 'tsne')
+    perplexity = float(request.args.get('perplexity', 40.0))
     try:
-        projection = _manager.model_state_projection(model, state_name, layer, method)
+        projection = _manager.model_state_projection(model, state_name, layer, method, perplexity)
         if projection is None:
             return 'Cannot find model with name {:s}'.format(model), 404
         return projection
@@ -156,27 +175,75 @@ def state_projection():
         # return 'page not found', 404
 
 
+@app.route('/projection/progress')
+def state_projection_progress():
+    """
+    Poll this to get the intermediate layouts of a projection, which is started by the first request
+    """
+    model = request.args.get('model', '')
+    state_name = request.args.get('state', '')
+    layer = int(request.args.get('layer', -1))
+    method = request.args.get('method', 'tsne')
+    perplexity = float(request.args.get('perplexity', 40.0))
+    progress = _manager.model_projection_progress(model, state_name, layer, method, perplexity)
+    if progress is None:
+        return 'Cannot find model with name {:s}'.format(model), 404
+    return jsonify(progress)
+
+
+@app.route('/embedding_projection')
+def embedding_projection():
+    """
+    Project the embedding (weights=embedding) or the output projection (weights=project) of the words
+    """
+    model = request.args.get('model', '')
+    weights = request.args.get('weights', 'embedding')
+    top_k = request.args.get('top_k', None)
+    top_k = None if top_k is None else int(top_k)
+    method = request.args.get('method', 'mds')
+    perplexity = float(request.args.get('perplexity', 40.0))
+    if method not in ['mds', 'tsne']:
+        return 'Unknown projection method {:s}'.format(method), 500
+    points = _manager.model_weights_projection(model, weights, top_k, method, perplexity)
+    if points is None:
+        return 'Cannot find model with name {:s} or its {:s} weights'.format(model, weights), 404
+    return jsonify(points)
+
+
 @app.route('/co_clusters')
 def co_cluster():
     model = request.args.get('model', '')
     state_name = request.args.get('state', '')
     layer = int(request.args.get('layer', -1))
-    top_k = int(request.args.get('top_k', 100))
+    top_k = request.args.get('top_k', '100')
+    top_k = None if top_k == 'all' else int(top_k)
     mode = request.args.get('mode', 'positive')
     seed = int(request.args.get('seed', 0))
     method = request.args.get('method', 'cocluster')
     n_cluster = request.args.get('n_cluster', '2').split(',')
     n_cluster = [int(e) for e in n_cluster]
-    if method == 'cocluster':
+    seeds = [int(e) for e in request.args.get('seeds', str(seed)).split(',')]
+    if top_k is None and method != 'minibatch':
+        return 'Only minibatch supports top_k=all', 500
+    if method == 'cocluster' and (len(n_cluster) > 1 or len(seeds) > 1):
+        # a sweep over several n_cluster and seeds, sharing the same spectral embedding
+        results = _manager.model_co_clusters(model, state_name, n_cluster, layer, top_k, mode, seeds)
+        if results is None:
+            return 'Cannot find model with name {:s}'.format(model), 404
+        return jsonify({'data': results[0],
+                        'ids': results[1],
+                        'words': results[2],
+                        'clusterings': results[3]})
+    if method == 'cocluster' or method == 'minibatch':
         if len(n_cluster) > 1:
-            return 'When using cocluster, you can only set n_clsuter to ONE integer', 500
+            return 'When using minibatch, you can only set n_clsuter to ONE integer', 500
         n_cluster = n_cluster[0]
     elif method == 'bicluster':
         if len(n_cluster) == 1:  # set cluster num of column of the same as the rows
             n_cluster.append(n_cluster[0])
     try:
         results = _manager.model_co_cluster(model, state_name, n_cluster, layer, top_k,
-                                            mode=mode, seed=seed, method=method)
+                                            mode=mode, seed=seeds[0], method=method)
         if results is None:
             return 'Cannot find model with name {:s}'.format(model), 404
         return jsonify({'data': results[0],
@@ -213,6 +280,78 @@ def state_statistics():
         raise
 
 
+@app.route('/comparative_statistics')
+def comparative_statistics():
+    models = request.args.get('models', '').split(',')
+    state_name = request.args.get('state', '')
+    layer = int(request.args.get('layer', -1))
+    top_k = int(request.args.get('top_k', 100))
+    try:
+        results = _manager.comparative_statistics(models, state_name, layer, top_k)
+    except ValueError as e:
+        return str(e), 500
+    if results is None:
+        return 'Cannot find models with names {:s}'.format(', '.join(models)), 404
+    return jsonify(results)
+
+
+@app.route('/bigram_statistics')
+def bigram_statistics():
+    model = request.args.get('model', '')
+    state_name = request.args.get('state', '')
+    layer = int(request.args.get('layer', -1))
+    top_k = int(request.args.get('top_k', 200))
+    word = request.args.get('word', None)
+    results = _manager.bigram_statistics(model, state_name, layer, top_k, word)
+    if results is None:
+        return 'Cannot find model with name {:s}'.format(model), 404
+    return jsonify(results)
+
+
+@app.route('/sentiment_trajectories')
+def sentiment_trajectories():
+    model = request.args.get('model', '')
+    state_name = request.args.get('state', '')
+    layer = int(request.args.get('layer', -1))
+    n_buckets = int(request.args.get('buckets', 10))
+    results = _manager.sentiment_trajectories(model, state_name, layer, n_buckets)
+    if results is None:
+        return 'Cannot find sentiment model with name {:s}'.format(model), 404
+    return jsonify(results)
+
+
+@app.route('/gate_statistics')
+def gate_statistics():
+    model = request.args.get('model', '')
+    gate_name = request.args.get('gate', '')
+    layer = int(request.args.get('layer', -1))
+    top_k = int(request.args.get('top_k', 200))
+    if gate_name not in ['gate', 'gate_i', 'gate_f', 'gate_o']:
+        return 'Unknown gate {:s}'.format(gate_name), 500
+    results = _manager.gate_statistics(model, gate_name, layer, top_k)
+    if results is None:
+        return 'Cannot find model with name {:s}'.format(model), 404
+    return jsonify(results)
+
+
+@app.route('/word_salience')
+def word_salience():
+    """
+    The precomputed salience of the states and gates w.r.t. a word
+    """
+    model = request.args.get('model', '')
+    word = request.args.get('word')  # required
+    y_or_x = request.args.get('y_or_x', 'y')
+    if word is None:
+        return 'The word is required', 500
+    if y_or_x not in ['x', 'y']:
+        return 'Unknown y_or_x {:s}'.format(y_or_x), 500
+    results = _manager.word_salience(model, word, y_or_x)
+    if results is None:
+        return 'Cannot find the salience of word {:s} of model {:s}'.format(str(word), model), 404
+    return jsonify(results)
+
+
 @app.route('/word_statistics')
 def word_statistics():
     model = request.args.get('model', '')
@@ -228,6 +367,55 @@ def word_statistics():
         raise
 
 
+@app.route('/unit_contexts')
+def unit_contexts():
+    """
+    The contexts that activate a unit most, both positively and negatively
+    """
+    model = request.args.get('model', '')
+    state_name = request.args.get('state', '')
+    layer = int(request.args.get('layer', -1))
+    unit = int(request.args.get('unit'))  # required
+    k = int(request.args.get('k', 10))
+    window = int(request.args.get('window', 5))
+    diff = request.args.get('diff', 'false').lower() == 'true'
+    if k > 50:
+        return 'Only the top 50 contexts of each unit are indexed', 500
+    results = _manager.unit_contexts(model, state_name, layer, unit, k, window, diff)
+    if results is None:
+        return 'Cannot find model with name {:s}'.format(model), 404
+    return jsonify(results)
+
+
+@app.route('/unit_similarity')
+def unit_similarity():
+    model = request.args.get('model', '')
+    state_name = request.args.get('state', '')
+    layers = [int(e) for e in request.args.get('layers', '-1').split(',')]
+    metric = request.args.get('metric', 'correlation')
+    diff = request.args.get('diff', 'true').lower() == 'true'
+    if metric not in ['correlation', 'cosine', 'covariance']:
+        return 'Unknown metric {:s}'.format(metric), 500
+    results = _manager.unit_similarity(model, state_name, layers, metric, diff)
+    if results is None:
+        return 'Cannot find model with name {:s}'.format(model), 404
+    return jsonify({'layers': layers, 'matrix': results})
+
+
+@app.route('/unit_histograms')
+def unit_histograms():
+    model = request.args.get('model', '')
+    state_name = request.args.get('state', '')
+    layer = int(request.args.get('layer', -1))
+    unit = request.args.get('unit', None)
+    unit = None if unit is None else int(unit)
+    diff = request.args.get('diff', 'true').lower() == 'true'
+    results = _manager.unit_histograms(model, state_name, layer, unit, diff)
+    if results is None:
+        return 'Cannot find model with name {:s}'.format(model), 404
+    return jsonify(results)
+
+
 @app.route('/pos_statistics')
 def pos_statistics():
     model = request.args.get('model', '')
@@ -239,3 +427,17 @@ def pos_statistics():
         return jsonify(results)
     except:
         raise
+
+
+@app.route('/cache')
+def cache_stats():
+    return jsonify(_manager.cache_stats())
+
+
+@app.route('/cache/purge', methods=['POST'])
+def purge_cache():
+    model = request.args.get('model', None)
+    purged = _manager.purge_cache(model)
+    if purged is None:
+        return 'Cannot find model with name {:s}'.format(model), 404
+    return jsonify({'purged': purged})
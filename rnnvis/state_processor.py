@@ -3,16 +3,18 @@ Helpers that deal with all the computations related to hidden states
 For example usage, see the main function below
 """
 
+import os
 import pickle
-from functools import lru_cache
-from collections import Counter, defaultdict
+from collections import defaultdict
 
 import numpy as np
-from scipy.spatial.distance import pdist, squareform
 
 from rnnvis.db import get_dataset
-from rnnvis.db.db_helper import query_evals, query_evaluation_records, get_datasets_by_name
-from rnnvis.utils.io_utils import file_exists, get_path, dict2json, before_save
+from rnnvis.db.db_helper import query_evals, query_evaluation_records, get_datasets_by_name, query_eval_data
+from rnnvis.utils.io_utils import file_exists, get_path, dict2json, dump_arrays, load_arrays, arrays_exist, \
+    atomic_dump
+from rnnvis.utils.cache import memory_cached, single_flight
+from rnnvis.datasets.text_processor import pos_tag_list, pos_tag_code
 from rnnvis.vendor import tsne, mds
 
 _tmp_dir = '_cached/tmp'
@@ -22,42 +24,74 @@ _tmp_dir = '_cached/tmp'
 #############
 
 
-@lru_cache(maxsize=32)
+@memory_cached
 def get_empirical_strength(data_name, model_name, state_name, layer=-1, top_k=100):
     """
-    A helper function that wraps cal_empirical_strength and cached the results in .pkl file for latter use
+    A helper function that wraps cal_empirical_strength and cached the results on disk for latter use
     :param data_name:
     :param model_name:
     :param state_name:
-    :param layer: specify a layer, start from 0
+    :param layer: specify a layer or a list of layers, start from 0
     :param top_k: get the strength of the top k frequent words
     :return: a list of strength mat (np.ndarray) of shape [len(layer), state_size]
     """
-    if not isinstance(layer, list):
-        layer = [layer]
+    layer = _as_list(layer)
     if top_k > 1000:
         raise ValueError("selected words range too large, only support top 1000 frequent words!")
     top = 100 if top_k <= 100 else 500 if top_k <= 500 else 1000
-    tmp_file = '-'.join([data_name, model_name, 'strength', state_name, str(top)]) + '.pkl'
+    tmp_file = '-'.join([data_name, model_name, 'strength', state_name, _layer_tag(layer), str(top)])
     tmp_file = get_path(_tmp_dir, tmp_file)
 
     def cal_fn():
         # words, states = load_words_and_state(data_name, model_name, state_name, diff=True)
-        id_to_states = load_sorted_words_states(data_name, model_name, state_name, diff=True)
-        return cal_empirical_strength(id_to_states[:top], lambda state_mat: np.mean(state_mat, axis=0))
+        id_to_states = load_sorted_words_states(data_name, model_name, state_name, diff=True, layers=layer)
+        return np.stack(cal_empirical_strength(id_to_states[:top], lambda state_mat: np.mean(state_mat, axis=0)))
 
     id_strengths = maybe_calculate(tmp_file, cal_fn)
 
-    return [id_strengths[i][layer] for i in range(top_k)]
+    return [id_strengths[i] for i in range(top_k)]
 
 
-@lru_cache(maxsize=128)
+def get_vocab_strength(data_name, model_name, state_name, layer=-1):
+    """
+    Calculate the empirical strength (the mean of the state differences) of every word in the vocabulary,
+        in one streaming pass over the states, the results are cached on disk.
+    :param layer: specify a layer or a list of layers, start from 0
+    :return: an ndarray of shape [n_words, len(layer), state_size], which is zero for the words never seen,
+        n_words is the max id of the words seen plus 1
+    """
+    from scipy.sparse import csr_matrix
+    layer = _as_list(layer)
+    tmp_file = get_path(_tmp_dir, '-'.join([data_name, model_name, 'strength', state_name, _layer_tag(layer), 'all']))
+
+    def cal_fn():
+        sums = np.zeros((0, 0))
+        counts = np.zeros(0)
+        for word_ids, states in iter_states(data_name, model_name, state_name, diff=True, layers=layer):
+            states = states.reshape(len(word_ids), -1)
+            n_words = max(int(np.max(word_ids)) + 1, len(counts))
+            if n_words > len(counts):
+                sums = np.vstack([sums.reshape(-1, states.shape[1]),
+                                  np.zeros((n_words - len(counts), states.shape[1]))])
+                counts = np.append(counts, np.zeros(n_words - len(counts)))
+            # sum the states of each word by a sparse one-hot matrix of shape [n_words, chunk]
+            onehot = csr_matrix((np.ones(len(word_ids)), (word_ids, np.arange(len(word_ids)))),
+                                shape=(n_words, len(word_ids)))
+            sums += onehot.dot(states)
+            counts += np.bincount(word_ids, minlength=n_words)
+        strength = sums / np.maximum(counts, 1)[:, None]
+        return strength.reshape(len(counts), len(layer), -1).astype(np.float32)
+
+    return maybe_calculate(tmp_file, cal_fn)
+
+
+@memory_cached
 def get_an_empirical_strength(data_name, model_name, state_name, layer, k):
-    id_to_states = load_sorted_words_states(data_name, model_name, state_name, diff=True)
+    id_to_states = load_sorted_words_states(data_name, model_name, state_name, diff=True, layers=layer)
     strength_list = cal_empirical_strength([id_to_states[k]], lambda state_mat: np.mean(state_mat, axis=0))
     strength = strength_list[0]
     if np.max(np.abs(strength)) > 1e-8:
-        return strength[layer]
+        return strength[0]
     return None
 
 
@@ -78,48 +112,60 @@ def strength2json(strength_list, words, labels=None, path=None):
     return dict2json(points, path)
 
 
-@lru_cache(maxsize=32)
-def get_state_signature(data_name, model_name, state_name, layer=None, sample_size=5000, dim=50):
+@memory_cached
+def get_state_signature(data_name, model_name, state_name, layer=None, sample_size=5000, dim=50, seed=0):
     """
     A helper function that sampled the states records,
         and maybe do PCA (if `sample size` is different from `dim`).
         The results will be cached on disk.
+    The states are sampled without replacement by streaming through the records with reservoir sampling,
+        so the memory used scales with `sample_size` rather than the size of the dataset.
     :param data_name: str
     :param model_name: str
     :param state_name: str
     :param layer: start from 0
-    :param sample_size:
+    :param sample_size: the number of sampled words, if there are fewer records, all of them are used.
+        If None, all the states are streamed into an incremental PCA without sampling, `dim` should be set.
     :param dim:
-    :return:
+    :param seed: the random seed of the sampling
+    :return: an ndarray of shape [len(layer) * n_units, dim or sample_size]
     """
     if layer is not None:
-        if not isinstance(layer, list):
-            layer = [layer]
+        layer = _as_list(layer)
     layer_str = 'all' if layer is None else ''.join([str(l) for l in layer])
+    if sample_size is None and dim is None:
+        raise ValueError("dim should be set when using all the states!")
     file_name = '-'.join([data_name, model_name, state_name, 'all' if layer is None else layer_str,
-                          str(sample_size), str(dim) if dim is not None else str(sample_size)]) + '.pkl'
+                          str(sample_size or 'all'), str(dim) if dim is not None else str(sample_size), str(seed)])
     file_name = get_path(_tmp_dir, file_name)
 
     def cal_fn(layers):
-        words, states = load_words_and_state(data_name, model_name, state_name, diff=False)
-        layers = layers if layers is not None else list(range(states[0].shape[0]))
-        state_layers = []
-        for l in layers:
-            state_layers.append([state[l, :] for state in states])
-        states_mat = np.hstack(state_layers).T
+        if sample_size is None:
+            print("doing incremental PCA over all the states...")
+            ipca = None
+            for _, states in iter_states(data_name, model_name, state_name, False, layers):
+                states = states.transpose(1, 2, 0).reshape(-1, states.shape[0])
+                ipca = tsne.IncrementalPCA(states.shape[0]) if ipca is None else ipca
+                ipca.partial_fit(states)
+            sample, variance = ipca.transform(dim)
+            print("PCA kept {:f}% of variance".format(variance * 100))
+            return sample
         print("sampling")
-        sample_idx = np.random.randint(0, states_mat.shape[1], sample_size)
-        sample = states_mat[:, sample_idx]
+        chunks = (states for _, states in iter_states(data_name, model_name, state_name, False, layers))
+        sample = reservoir_sample(chunks, sample_size, seed)
+        # [sample_size, n_layer, n_units] => [n_layer * n_units, sample_size]
+        sample = sample.transpose(1, 2, 0).reshape(-1, sample.shape[0])
         if dim is not None:
             print("doing PCA...")
-            sample, variance = tsne.pca(sample, dim)
+            sample, variance = tsne.pca(sample, dim, seed=seed)
             print("PCA kept {:f}% of variance".format(variance * 100))
         return sample
 
     return maybe_calculate(file_name, cal_fn, layer)
 
 
-def get_tsne_projection(data_name, model_name, state_name, layer=-1, sample_size=5000, dim=50, perplexity=40.0):
+def get_tsne_projection(data_name, model_name, state_name, layer=-1, sample_size=5000, dim=50, perplexity=40.0,
+                        callback=None, init=None, max_iter=None):
     """
     A helper function that wraps get_state_signature and tsne_project,
         the results will be chached on disk for latter use.
@@ -130,22 +176,266 @@ def get_tsne_projection(data_name, model_name, state_name, layer=-1, sample_size
     :param sample_size:
     :param dim:
     :param perplexity:
+    :param callback: an optional function called with the intermediate solutions, see tsne.TSNE.run
+    :param init: warm start the projection from a previous layout of the same units, can be:
+        None, start from random;
+        'auto', use a cached solution of the same model with another perplexity, if any;
+        a str of another model name, e.g., a previous checkpoint of the same model;
+        or an ndarray of shape [n_units, 2]
+    :param max_iter: the iterations to run, default to 1000, or 300 when warm started
     :return:
     """
     assert isinstance(layer, int), "tsne projection of only one layer is reasonable"
-    tmp_file = '-'.join([data_name, model_name, state_name, 'tsne',
-                         str(layer), str(dim), str(int(perplexity))]) + '.pkl'
-    tmp_file = get_path(_tmp_dir, tmp_file)
+    tmp_file = _tsne_file(data_name, model_name, state_name, layer, dim, perplexity)
 
     def cal_fn():
         sample = get_state_signature(data_name, model_name, state_name, layer, sample_size, dim) / 50
-        print('Start doing t-SNE...')
-        return tsne_project(sample, perplexity, dim, lr=50)
+        init_Y, iters = resolve_tsne_init(data_name, model_name, state_name, layer, dim, perplexity, init)
+        if init_Y is not None and init_Y.shape[0] != sample.shape[0]:
+            print("WARN: the initial layout does not match the units, start from random")
+            init_Y, iters = None, 1000
+        if init_Y is not None:
+            print('Start doing t-SNE from a previous layout...')
+        else:
+            print('Start doing t-SNE...')
+        if max_iter is not None:
+            iters = max_iter
+        return tsne_project(sample, perplexity, dim, lr=50, max_iter=iters, callback=callback, init=init_Y)
 
     tsne_solution = maybe_calculate(tmp_file, cal_fn)
     return tsne_solution
 
 
+def resolve_tsne_init(data_name, model_name, state_name, layer=-1, dim=50, perplexity=40.0, init=None):
+    """
+    Resolve the init of get_tsne_projection into an initial layout and the default iterations to run,
+        so that a caller knows how many iterations a projection job will take before starting it
+    :param init: see get_tsne_projection
+    :return: a pair (init_Y, max_iter), init_Y is None if starting from random,
+        max_iter is 1000, or 300 when warm started
+    """
+    init_Y = init
+    if isinstance(init, str):
+        # 'auto' for the same model with another perplexity, or the name of another model
+        init_model = model_name if init == 'auto' else init
+        init_Y = find_cached_projection(data_name, init_model, state_name, layer, dim, perplexity)
+    return init_Y, 1000 if init_Y is None else 300
+
+
+def _tsne_file(data_name, model_name, state_name, layer, dim, perplexity):
+    return get_path(_tmp_dir, '-'.join([data_name, model_name, state_name, 'tsne',
+                                        str(layer), str(dim), str(int(perplexity))]))
+
+
+def find_cached_projection(data_name, model_name, state_name, layer=-1, dim=50, perplexity=40.0):
+    """
+    Find a cached t-SNE solution of the given units
+    :param perplexity: the solution with the nearest perplexity among all the cached ones is returned
+    :return: an ndarray of shape [n_units, 2], or None if not found
+    """
+    prefix = os.path.basename(_tsne_file(data_name, model_name, state_name, layer, dim, 0))[:-1]
+    candidates = _cached_variants(prefix)
+    if not candidates:
+        return None
+    best = min(candidates, key=lambda p: abs(p - perplexity))
+    return load_arrays(get_path(_tmp_dir, prefix + str(best)))
+
+
+def _cached_variants(prefix):
+    """
+    Scan the complete array stores in the tmp dir named by the prefix followed by an int
+    :param prefix: the file name prefix
+    :return: a list of the ints of the stores
+    """
+    tmp_dir = get_path(_tmp_dir)
+    variants = []
+    if os.path.isdir(tmp_dir):
+        for name in os.listdir(tmp_dir):
+            if name.startswith(prefix) and name[len(prefix):].isdigit() \
+                    and arrays_exist(os.path.join(tmp_dir, name)):
+                variants.append(int(name[len(prefix):]))
+    return variants
+
+
+def batch_projections(jobs, workers=None, max_iter=None):
+    """
+    Run a batch of t-SNE projections on a process pool, the solutions are written into the same disk cache
+        as get_tsne_projection, so that later requests can be served directly.
+    Jobs of the same units (data_name, model_name, state_name, layer) are run one after another in one worker,
+        so that the signature of the units is computed once, and each perplexity warm starts from the previous one.
+    :param jobs: a list of tuples (data_name, model_name, state_name, layer, perplexity)
+    :param workers: the number of worker processes,
+        default to the env var RNNVIS_WORKERS if set, else the number of cpus
+    :param max_iter: the iterations of each job, see get_tsne_projection
+    :return: a list of error messages in the order of jobs, None for the succeeded ones
+    """
+    groups = defaultdict(list)
+    for i, job in enumerate(jobs):
+        groups[tuple(job[:4])].append((i, job[4]))
+    errors = [None] * len(jobs)
+    with _spawn_pool(min(_n_workers(workers), len(groups))) as pool:
+        results = pool.starmap(_run_projection_group, [(units, sorted(group, key=lambda e: e[1]), max_iter)
+                                                       for units, group in groups.items()])
+    for result in results:
+        for i, error in result:
+            errors[i] = error
+    return errors
+
+
+def _n_workers(workers=None):
+    """
+    :param workers: the number of worker processes, if None,
+        default to the env var RNNVIS_WORKERS if set, else the number of cpus
+    :return: the number of worker processes
+    """
+    if workers is None:
+        import multiprocessing
+        workers = int(os.environ.get('RNNVIS_WORKERS', multiprocessing.cpu_count()))
+    return max(1, workers)
+
+
+def _spawn_pool(processes):
+    """
+    A pool of spawned worker processes, a forked db connection or tensorflow runtime is not safe to use
+    :param processes: the number of worker processes
+    :return: a multiprocessing.Pool
+    """
+    import multiprocessing
+    return multiprocessing.get_context('spawn').Pool(max(1, processes))
+
+
+def _run_projection_group(units, group, max_iter):
+    data_name, model_name, state_name, layer = units
+    results = []
+    for i, perplexity in group:
+        try:
+            get_tsne_projection(data_name, model_name, state_name, layer, 5000, 50, perplexity,
+                                init='auto', max_iter=max_iter)
+            results.append((i, None))
+        except Exception as e:
+            print("ERROR: projection of {:s} failed: {:s}".format(str(units + (perplexity,)), str(e)))
+            results.append((i, str(e)))
+    return results
+
+
+def get_mds_projection(data_name, model_name, state_name, layer=-1, sample_size=5000, dim=50, n_landmarks=300):
+    """
+    A helper function that wraps get_state_signature and mds_project,
+        the results will be cached on disk like get_tsne_projection.
+    Landmark MDS is deterministic and much faster than t-SNE, it preserves the global distances
+        rather than the local neighborhoods.
+    :param n_landmarks: the number of landmarks used by the landmark MDS
+    :return: an ndarray of shape [n_units, 2]
+    """
+    assert isinstance(layer, int), "mds projection of only one layer is reasonable"
+    tmp_file = get_path(_tmp_dir, '-'.join([data_name, model_name, state_name, 'mds',
+                                            str(layer), str(dim), str(n_landmarks)]))
+
+    def cal_fn():
+        sample = get_state_signature(data_name, model_name, state_name, layer, sample_size, dim)
+        print('Start doing landmark MDS...')
+        return mds_project(sample, n_landmarks)
+
+    return maybe_calculate(tmp_file, cal_fn)
+
+
+def get_weights_projection(model_name, weights_name, weights, checkpoint_tag, top_k=None, method='mds',
+                           perplexity=40.0):
+    """
+    Project the rows of a weights matrix (e.g., the embedding of each word), the results are cached on disk
+        per checkpoint of the model.
+    :param model_name: name of the model
+    :param weights_name: 'embedding' or 'project', only used to name the cache
+    :param weights: an ndarray of shape [vocab_size, n_features], or a function that returns it,
+        which is only called when the projection is not cached
+    :param checkpoint_tag: a str identifying the checkpoint of the weights
+    :param top_k: only project the first top_k rows, i.e., the top_k most frequent words, None for all
+    :param method: 'mds' for landmark MDS, or 'tsne' for (Barnes-Hut) t-SNE,
+        both scale to the full vocabulary, while landmark MDS takes seconds and t-SNE takes minutes
+    :param perplexity: the perplexity used by t-SNE
+    :return: an ndarray of shape [top_k, 2]
+    """
+    if method not in ('mds', 'tsne'):
+        raise ValueError("Unknown projection method {:s}".format(str(method)))
+    tmp_file = get_path(_tmp_dir, '-'.join([model_name, weights_name, checkpoint_tag, method, str(top_k)]
+                                           + ([str(int(perplexity))] if method == 'tsne' else [])))
+
+    def cal_fn():
+        data = weights() if callable(weights) else weights
+        data = np.asarray(data[:top_k], dtype=np.float64)
+        print('Start projecting {:s} weights of shape {:s}...'.format(weights_name, str(data.shape)))
+        if method == 'mds':
+            return mds_project(data)
+        return tsne_project(data, perplexity, min(50, data.shape[1]))
+
+    return maybe_calculate(tmp_file, cal_fn)
+
+
+def _salience_file(model_name, y_or_x, top_k):
+    return get_path(_tmp_dir, '-'.join([model_name, 'salience', y_or_x, str(top_k)]))
+
+
+def get_salience(model_name, y_or_x='y', top_k=None):
+    """
+    Load the salience of the most frequent words of a model precomputed by batch_salience
+    :param top_k: find the smallest store that covers at least the top_k words, None for the largest store
+    :return: a dict {'checkpoint', 'fields'}, 'checkpoint' is the checkpoint of the model used,
+        'fields' is a dict {field_name: [salience of layer_0, ...]},
+        the salience of each layer is an ndarray of shape [n_words, n_units]
+        (or [n_words, embedding_size] if y_or_x is 'x'), the row i is the salience of word i.
+        None if no such store is precomputed
+    """
+    prefix = os.path.basename(_salience_file(model_name, y_or_x, ''))
+    candidates = _cached_variants(prefix)
+    if top_k is not None:
+        candidates = [k for k in candidates if k >= top_k]
+    if not candidates:
+        return None
+    best = max(candidates) if top_k is None else min(candidates)
+    return load_arrays(_salience_file(model_name, y_or_x, best))
+
+
+def batch_salience(config_file, model_name, top_k=1000, y_or_x='y', workers=None, batch_size=50):
+    """
+    Compute the salience of the states and gates of a model w.r.t. each of the top_k words,
+        the words are sharded across worker processes, each of which builds and restores the model in its own session.
+    The results are dumped to a per-model array store, see get_salience
+    :param config_file: the config file of the model
+    :param model_name: the name of the model
+    :param top_k: compute the salience of the word ids 0 ... top_k-1, i.e., the top_k most frequent words
+    :param y_or_x: 'y' or 'x', see rnn.evaluator.cal_jacobian, the full Jacobian is too large to store
+    :param workers: the number of worker processes,
+        default to the env var RNNVIS_WORKERS if set, else the number of cpus
+    :param batch_size: the number of words whose salience are computed in one run
+    :return: the same as get_salience
+    """
+    if y_or_x not in ('x', 'y'):
+        raise ValueError("y_or_x should be 'x' or 'y', but got {:s}".format(str(y_or_x)))
+
+    def cal_fn():
+        shards = [shard.tolist() for shard in np.array_split(np.arange(top_k), _n_workers(workers)) if len(shard)]
+        print('Start computing salience of {:d} words with {:d} workers...'.format(top_k, len(shards)))
+        with _spawn_pool(len(shards)) as pool:
+            results = pool.starmap(_salience_shard, [(config_file, shard, y_or_x, batch_size) for shard in shards])
+        fields = {name: [np.concatenate([result[1][name][i] for result in results]) for i in range(len(layers))]
+                  for name, layers in results[0][1].items()}
+        return {'checkpoint': results[0][0], 'fields': fields}
+
+    return maybe_calculate(_salience_file(model_name, y_or_x, top_k), cal_fn)
+
+
+def _salience_shard(config_file, word_ids, y_or_x, batch_size):
+    from rnnvis.procedures import build_model  # lazy import, only the workers need tensorflow
+    model, _ = build_model(config_file)
+    model.add_evaluator(batch_size, 1, 1, True)
+    model.restore()
+    saliences = model.run_with_context(model.evaluator.cal_salience, word_ids, y_or_x=y_or_x, verbose=False)
+    fields = {name: [np.stack([salience[name][i] for salience in saliences]).astype(np.float32)
+                     for i in range(len(layers))]
+              for name, layers in saliences[0].items()}
+    return model.checkpoint, fields
+
+
 def solution2json(solution, states_num, labels=None, path=None):
     """
     Convert the tsne solution to json format
@@ -155,6 +445,13 @@ def solution2json(solution, states_num, labels=None, path=None):
     :param path:
     :return:
     """
+    return dict2json(solution2points(solution, states_num, labels), path)
+
+
+def solution2points(solution, states_num, labels=None):
+    """
+    Convert the tsne solution to a list of points, see solution2json
+    """
     if isinstance(solution, np.ndarray):
         solution = solution.tolist()
     if isinstance(labels, np.ndarray):
@@ -168,53 +465,139 @@ def solution2json(solution, states_num, labels=None, path=None):
         state_ids += list(range(num))
     points = [{'coords': s, 'layer': layers[i], 'state_id': state_ids[i], 'label': labels[i]}
               for i, s in enumerate(solution)]
-    return dict2json(points, path)
+    return points
 
 
-@lru_cache(maxsize=32)
-def load_words_and_state(data_name, model_name, state_name, diff=True):
+@memory_cached
+def load_words_and_state(data_name, model_name, state_name, diff=True, layers=None, units=None):
     """
-    A wrapper function that wraps fetch_states and cached the results in .pkl file for latter use
+    A wrapper function that wraps fetch_states and cached the results on disk for latter use
     :param data_name:
     :param model_name:
     :param state_name:
     :param diff:
-    :return: a pair of two list (word_list, states_list)
+    :param layers: a layer or a list of layers to load, if None, load all the layers.
+        Each layer is cached in its own file, so loading a layer only reads the bytes of that layer.
+    :param units: a list of units to keep, if None, keep all the units.
+        The units are selected in memory from the loaded layers.
+    :return: a pair (word_ids, states), word_ids is an int ndarray of shape [n_words],
+        states is an ndarray of shape [n_words, n_layer, n_units]
     """
+    if layers is None:
+        states_file = _states_file(data_name, model_name, state_name, diff)
 
-    states_file = data_name + '-' + model_name + '-' + 'words' + '-' + state_name + ('-diff' if diff else '') + '.pkl'
-    states_file = get_path(_tmp_dir, states_file)
-
-    def cal_fn():
-        return fetch_states(data_name, model_name, state_name, diff)
+        def cal_fn():
+            words, states = fetch_states(data_name, model_name, state_name, diff)
+            return np.array(words, dtype=np.int32), np.asarray(states)
 
-    words, states = maybe_calculate(states_file, cal_fn)
+        words, states = maybe_calculate(states_file, cal_fn)
+    else:
+        layer_states = [_load_layer_states(data_name, model_name, state_name, diff, l) for l in _as_list(layers)]
+        words = layer_states[0][0]
+        states = _stack_layers([states for _, states in layer_states])
+    if units is not None:
+        states = states[:, :, units]
     return words, states
 
 
-@lru_cache(maxsize=32)
-def load_sorted_words_states(data_name, model_name, state_name, diff=True):
+@memory_cached
+def load_sorted_words_states(data_name, model_name, state_name, diff=True, layers=None, units=None):
     """
     A wrapper function that wraps fetch_states and sort them according to ids,
-        and cached the results in .pkl file for latter use
+        and cached the results on disk for latter use
     :param data_name:
     :param model_name:
     :param state_name:
     :param diff:
-    :return: a pair of two list (word_list, states_list)
+    :param layers: a layer or a list of layers to load, if None, load all the layers, see load_words_and_state
+    :param units: a list of units to keep, if None, keep all the units.
+        The units are selected in memory from the loaded layers.
+    :return: a SortedStates instance, id_states[i] is an ndarray of shape [freq_i, n_layer, n_units]
+    """
+    if layers is None:
+        states_file = _states_file(data_name, model_name, state_name, diff, sorted_=True)
+
+        def cal_fn():
+            words, states = fetch_states(data_name, model_name, state_name, diff)
+            return sort_states_by_id(words, np.asarray(states))
+
+        sorted_states, offsets = maybe_calculate(states_file, cal_fn)
+    else:
+        layer_states = []
+        for l in _as_list(layers):
+            states_file = _states_file(data_name, model_name, state_name, diff, l, sorted_=True)
+
+            def cal_fn(layer_):
+                return sort_states_by_id(*_load_layer_states(data_name, model_name, state_name, diff, layer_))
+
+            sorted_states, offsets = maybe_calculate(states_file, cal_fn, l)
+            layer_states.append(sorted_states)
+        sorted_states = _stack_layers(layer_states)
+    if units is not None:
+        sorted_states = sorted_states[:, :, units]
+    return SortedStates(sorted_states, offsets)
+
+
+def _load_layer_states(data_name, model_name, state_name, diff, layer):
     """
-    states_file = '-'.join([data_name, model_name, 'words', state_name, 'sorted']) + ('-diff' if diff else '') + '.pkl'
-    states_file = get_path(_tmp_dir, states_file)
+    Load the states of a single layer
+    :return: a pair (word_ids, states), states is of shape [n_words, n_units]
+    """
+    states_file = _states_file(data_name, model_name, state_name, diff, layer)
 
     def cal_fn():
-        words, states = fetch_states(data_name, model_name, state_name, diff)
-        return sort_by_id(words, states)
+        full_file = _states_file(data_name, model_name, state_name, diff)
+        if arrays_exist(full_file):
+            words, states = load_arrays(full_file)
+            return np.array(words), np.array(states[:, layer])
+        return _fetch_layer_fields(data_name, model_name, state_name, diff, layer)
+
+    return maybe_calculate(states_file, cal_fn)
 
-    id_states = maybe_calculate(states_file, cal_fn)
-    return id_states
 
+def _fetch_layer_fields(data_name, model_name, state_name, diff, layer):
+    """
+    Fetch a layer of a field from db, the gates of the layer (if recorded and not cached yet) are fetched
+        in the same pass and cached as well, so that the records are only scanned once for the states and gates.
+    :return: a pair (word_ids, states) of the field
+    """
+    gate_fields = [field for field in _recorded_fields(data_name, model_name) if field.startswith('gate')
+                   and field != state_name and not arrays_exist(_states_file(data_name, model_name, field, False, layer))]
+    fields = [state_name] + gate_fields
+    diffs = [diff] + [False] * len(gate_fields)
+    words = []
+    field_states = [[] for _ in fields]
+    for eval in query_evals(data_name, model_name):
+        word_ids, states = fetch_state_of_eval(eval['_id'], fields, diffs, [layer])
+        if len(fields) == 1:  # fetch_state_of_eval unwraps a single field
+            states = [states]
+        words += word_ids
+        for i, state in enumerate(states):
+            field_states[i] += state
+    if not words:
+        raise LookupError("No eval records with data_name: {:s} and model_name: {:s}".format(data_name, model_name))
+    words = np.array(words, dtype=np.int32)
+    for field, states in zip(gate_fields, field_states[1:]):
+        dump_arrays((words, np.asarray(states)[:, 0]), _states_file(data_name, model_name, field, False, layer))
+    return words, np.asarray(field_states[0])[:, 0]
+
+
+@memory_cached
+def _recorded_fields(data_name, model_name):
+    evals = query_evals(data_name, model_name).limit(1)
+    for eval in evals:
+        return tuple(query_evaluation_records(eval['_id'], range(1))[0].keys())
+    return ()
+
+
+def _stack_layers(layer_states):
+    # a single layer [n_words, n_units] is viewed as [n_words, 1, n_units] without copying
+    if len(layer_states) == 1:
+        return layer_states[0][:, None, :]
+    return np.stack(layer_states, axis=1)
 
-@lru_cache(maxsize=32)
+
+@memory_cached
 def get_state_statistics(data_name, model_name, state_name, diff=True, layer=-1, top_k=500, k=None):
     """
     Get state statistics, i.e. states mean reaction, 25~75 reaction range, 9~91 reaction range regarding top_k words
@@ -245,39 +628,25 @@ def get_state_statistics(data_name, model_name, state_name, diff=True, layer=-1,
         end = 100 if top_k <= 100 else 500 if top_k <= 500 else 1000
     cal_range = range(start, end)
 
-    tmp_file = '-'.join([data_name, model_name, state_name, 'statistics', str(start), str(end)]) \
-               + ('-diff' if diff else '') + '.pkl'
+    tmp_file = '-'.join([data_name, model_name, state_name, 'statistics', _layer_tag([layer]), str(start), str(end)]) \
+               + ('-diff' if diff else '')
     tmp_file = get_path(_tmp_dir, tmp_file)
 
     def cal_fn(data_name_, model_name_, state_name_, diff_, range_):
         # _words, states = load_words_and_state(data_name_, model_name_, state_name_, diff_)
-        id_to_states = load_sorted_words_states(data_name_, model_name_, state_name_, diff_)
+        id_to_states = load_sorted_words_states(data_name_, model_name_, state_name_, diff_, layers=layer)
         _words = get_datasets_by_name(data_name_, ['id_to_word'])['id_to_word']
-        words = []
-        state_shape = id_to_states[0][0].shape
-        dtype = id_to_states[0][0].dtype
-        layer_num = state_shape[0]
-        stats_list = []
-        for i in range_:
-            id_to_state = id_to_states[i]
-            if id_to_state is None:  # some words may be seen in test set
-                states = [np.zeros(state_shape, dtype)]  # use zeros as placeholder
-            else:
-                states = id_to_state
-            stats_list.append(cal_state_statistics(states))
-            words.append(_words[i])
+        words = [_words[i] for i in range_]
+        stats = cal_grouped_statistics(id_to_states, range_)
         stats_layer_wise = []
-        for layer_ in range(layer_num):
-            stats = {}
-            for field in stats_list[0][layer_].keys():
-                value = np.vstack([stat[layer_][field] for stat in stats_list])
-                stats[field] = value
-            stats['freqs'] = np.array([len(id_state) if id_state is not None else 0 for id_state in id_to_states])
-            stats_layer_wise.append(stats)
+        for layer_ in range(id_to_states.states.shape[1]):
+            layer_stats = {field: value[:, layer_] for field, value in stats.items()}
+            layer_stats['freqs'] = id_to_states.freqs
+            stats_layer_wise.append(layer_stats)
         return stats_layer_wise, words
 
     layer_wise_stats, words = maybe_calculate(tmp_file, cal_fn, data_name, model_name, state_name, diff, cal_range)
-    stats = layer_wise_stats[layer]
+    stats = layer_wise_stats[0]
     if k is None:
         # stats = {key: value[:(top_k)].tolist() for key, value in stats.items()}
         results = defaultdict(list)
@@ -296,6 +665,248 @@ def get_state_statistics(data_name, model_name, state_name, diff=True, layer=-1,
     return results
 
 
+@memory_cached
+def get_comparative_statistics(data_name, model_names, state_name, diff=True, layer=-1, top_k=100, workers=None):
+    """
+    Get the state statistics of several models evaluated on the same data, regarding the same top_k words.
+    The word grouping and the top_k selection are computed once and shared by the models,
+        and the statistics of the models are computed in parallel threads.
+    :param model_names: a list of model names
+    :param layer: the layer of the states
+    :param top_k: the statistics of the top_k frequent words
+    :param workers: the number of threads, default to the number of models
+    :return: a dict {'ids', 'freqs', 'models'}, 'ids' and 'freqs' are the ids and the frequencies of the words,
+        'models' is a dict {model_name: stats}, each stats is a dict {'mean', 'low1', ..., 'sort_idx'}
+        of arrays of shape [top_k, n_units], aligned with 'ids', see get_state_statistics
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    words = _load_layer_states(data_name, model_names[0], state_name, diff, layer)[0]
+    order, offsets = _group_by_id(words)
+    ids = np.nonzero(np.diff(offsets))[0][:top_k]
+    freqs = offsets[ids + 1] - offsets[ids]
+    # the records of the top_k words, grouped by word
+    selected = np.concatenate([order[offsets[i]:offsets[i+1]] for i in ids])
+    selected_offsets = np.concatenate([[0], np.cumsum(freqs)])
+
+    def model_stats(model_name):
+        model_words, states = _load_layer_states(data_name, model_name, state_name, diff, layer)
+        if np.array_equal(model_words, words):
+            return _grouped_stats_of_rows(states, selected, selected_offsets)
+        # evaluated on other records of the data, the grouping cannot be shared
+        print("WARN: {:s} is evaluated on different records, grouping its words again".format(model_name))
+        model_order, model_offsets = _group_by_id(model_words)
+        model_offsets = np.pad(model_offsets, (0, max(0, ids[-1] + 2 - len(model_offsets))), 'edge')
+        rows = np.concatenate([model_order[model_offsets[i]:model_offsets[i+1]] for i in ids])
+        model_freqs = model_offsets[ids + 1] - model_offsets[ids]
+        return _grouped_stats_of_rows(states, rows, np.concatenate([[0], np.cumsum(model_freqs)]))
+
+    with ThreadPoolExecutor(max_workers=workers or len(model_names)) as executor:
+        stats = list(executor.map(model_stats, model_names))
+    return {'ids': ids, 'freqs': freqs, 'models': dict(zip(model_names, stats))}
+
+
+def _group_by_id(word_ids):
+    """
+    :return: a pair (order, offsets), the records of word i are order[offsets[i]:offsets[i+1]]
+    """
+    word_ids = np.asarray(word_ids)
+    order = np.argsort(word_ids, kind='mergesort')
+    offsets = np.concatenate([[0], np.cumsum(np.bincount(word_ids))])
+    return order, offsets
+
+
+def _grouped_stats_of_rows(states, rows, offsets):
+    grouped = SortedStates(np.asarray(states)[rows][:, None, :], offsets)
+    stats = cal_grouped_statistics(grouped, range(len(offsets) - 1))
+    return {field: value[:, 0] for field, value in stats.items()}
+
+
+@memory_cached
+def get_bigram_statistics(data_name, model_name, state_name, diff=True, layer=-1, top_n=1000):
+    """
+    Get the state statistics regarding the top_n frequent (previous word, word) pairs,
+        computed by sorting the records by the pair keys and segmenting them, the results are cached on disk.
+    :param layer: the layer of the states
+    :param top_n: the number of the most frequent pairs
+    :return: a dict {'pairs', 'freqs', 'mean', 'low1', 'high1', 'low2', 'high2', 'sort_idx'},
+        'pairs' is an int ndarray of shape [top_n, 2] of (prev_word_id, word_id), sorted by frequency,
+        the statistics are of shape [top_n, n_units], see get_state_statistics
+    """
+    tmp_file = get_path(_tmp_dir, '-'.join([data_name, model_name, state_name, 'bigram', _layer_tag([layer]),
+                                            str(top_n)]) + ('-diff' if diff else ''))
+
+    def cal_fn():
+        words, states = _load_layer_states(data_name, model_name, state_name, diff, layer)
+        words = np.asarray(words, dtype=np.int64)
+        prev_words = np.roll(words, 1)
+        # the first word of an eval has no previous word
+        lengths = _eval_lengths(data_name, model_name)
+        if sum(lengths) != len(words):
+            raise ValueError("The cached states do not match the eval records, please purge the cache")
+        prev_words[np.cumsum([0] + lengths[:-1])] = -1
+        n_words = int(words.max()) + 1
+        keys = np.where(prev_words >= 0, prev_words * n_words + words, -1)
+        unique_keys, counts = np.unique(keys[keys >= 0], return_counts=True)
+        top = np.argsort(-counts, kind='mergesort')[:top_n]
+        top_keys = unique_keys[top]
+        # sort the records of the top pairs by the rank of their pairs, and segment them
+        rank = np.full(len(unique_keys), -1)
+        rank[top] = np.arange(len(top))
+        record_rank = np.full(len(keys), -1)
+        valid = keys >= 0
+        record_rank[valid] = rank[np.searchsorted(unique_keys, keys[valid])]
+        selected = np.nonzero(record_rank >= 0)[0]
+        sorted_states, offsets = sort_states_by_id(record_rank[selected], np.asarray(states)[selected][:, None, :])
+        stats = cal_grouped_statistics(SortedStates(sorted_states, offsets), range(len(top)))
+        stats = {field: value[:, 0] for field, value in stats.items()}
+        stats['pairs'] = np.stack([top_keys // n_words, top_keys % n_words], axis=1)
+        stats['freqs'] = counts[top]
+        return stats
+
+    return maybe_calculate(tmp_file, cal_fn)
+
+
+def _eval_lengths(data_name, model_name):
+    """The number of records of each eval, in the same order as the records are fetched"""
+    return [len(eval['records']) for eval in query_evals(data_name, model_name) if eval.get('records')]
+
+
+def get_sentiment_trajectories(data_name, model_name, state_name, layer=-1, n_buckets=10, project=None,
+                               output_field=None, set_name='test', batch_size=256):
+    """
+    Aggregate the states of the recorded reviews of a sentiment dataset by (label, relative position bucket),
+        e.g., with 10 buckets, bucket 0 holds the states of the first 10% words of each review.
+        The reviews are processed in padded batches, the results are cached on disk
+        (not in memory, since project is a pair of ndarrays, which cannot be a cache key).
+    :param layer: the layer of the states
+    :param n_buckets: the number of relative position buckets
+    :param project: an optional pair (project_w, project_b) of the model, which is applied on the last output
+        of each review to get the predicted label, see RNN.project_weights
+    :param output_field: the field whose last layer is the output of the model, 'state_h' for LSTM or 'state'
+    :param set_name: the set of the recorded evals
+    :param batch_size: the number of reviews in a padded batch
+    :return: a dict {'gold': {'mean', 'counts'}, 'predicted': {'mean', 'counts'}, 'accuracy'},
+        'mean' is of shape [n_labels, n_buckets, n_units], 'counts' of shape [n_labels, n_buckets],
+        'predicted' and 'accuracy' are only available when project is given
+    """
+    predict = project is not None and output_field is not None
+    tmp_file = get_path(_tmp_dir, '-'.join([data_name, model_name, state_name, 'trajectories', _layer_tag([layer]),
+                                            str(n_buckets), set_name] + (['pred'] if predict else [])))
+
+    def cal_fn():
+        dataset = get_datasets_by_name(data_name, [set_name])[set_name]
+        min_label = min(dataset['label'])
+        # the evals are matched with the labels by their words, since the recorder may skip some sentences
+        sentence_labels = {tuple(sentence): label - min_label
+                           for sentence, label in zip(dataset['data'], dataset['label'])}
+        n_labels = max(sentence_labels.values()) + 1
+        kinds = ['gold', 'predicted'] if predict else ['gold']
+        sums = {}
+        counts = {kind: np.zeros(n_labels * n_buckets) for kind in kinds}
+        n_reviews = 0
+        n_correct = 0
+        batch = []
+
+        def aggregate(batch):
+            lengths = np.array([len(states) for states, _ in batch])
+            max_len = lengths.max()
+            padded = np.zeros((len(batch), max_len, batch[0][0].shape[1]))
+            for i, (states, _) in enumerate(batch):
+                padded[i, :len(states)] = states
+            mask = np.arange(max_len) < lengths[:, None]
+            buckets = np.minimum(np.arange(max_len) * n_buckets // lengths[:, None], n_buckets - 1)
+            labels = np.array([labels_ for _, labels_ in batch])
+            for j, kind in enumerate(kinds):
+                keys = (labels[:, j, None] * n_buckets + buckets)[mask]
+                if kind not in sums:
+                    sums[kind] = np.zeros((n_labels * n_buckets, padded.shape[2]))
+                np.add.at(sums[kind], keys, padded[mask])
+                counts[kind] += np.bincount(keys, minlength=n_labels * n_buckets)
+
+        fields = [state_name, output_field] if predict else state_name
+        diffs = [False, False] if predict else False
+        for eval in query_evals(data_name, model_name, set_name):
+            label = sentence_labels.get(tuple(eval['data']))
+            if label is None or not eval.get('records'):
+                continue
+            _, states = fetch_state_of_eval(eval['_id'], fields, diffs)
+            labels = [label]
+            n_reviews += 1
+            if predict:
+                states, outputs = states
+                logits = np.dot(outputs[-1][-1], project[0]) + project[1]
+                labels.append(int(np.argmax(logits)))
+                n_correct += labels[1] == label
+            batch.append((np.stack(states)[:, layer], labels))
+            if len(batch) == batch_size:
+                aggregate(batch)
+                batch = []
+        if batch:
+            aggregate(batch)
+        if not sums:
+            raise LookupError("No labeled eval records with data_name: {:s} and model_name: {:s}"
+                              .format(data_name, model_name))
+        results = {}
+        for kind in kinds:
+            mean = sums[kind] / np.maximum(counts[kind], 1)[:, None]
+            results[kind] = {'mean': mean.reshape(n_labels, n_buckets, -1),
+                             'counts': counts[kind].reshape(n_labels, n_buckets).astype(np.int64)}
+        if predict:
+            results['accuracy'] = n_correct / n_reviews
+        return results
+
+    return maybe_calculate(tmp_file, cal_fn)
+
+
+@memory_cached
+def get_gate_statistics(data_name, model_name, gate_name, layer=-1, top_k=500, saturation=(0.1, 0.9)):
+    """
+    Get the statistics of a gate regarding the top_k words, and the statistics of each unit over all the words.
+    The gates are fetched from db in the same pass as the states, see _fetch_layer_fields.
+    :param gate_name: 'gate_i', 'gate_f', 'gate_o' for LSTM, or 'gate' for GRU
+    :param layer: the layer of the gate
+    :param top_k: the statistics of the top_k frequent words
+    :param saturation: a pair (low, high), the gate is regarded as saturated when it is below low or above high
+    :return: a dict containing statistics:
+        {
+            'mean', 'low1', 'high1', 'low2', 'high2', 'sort_idx': [top_k, n_units], see get_state_statistics,
+            'sat_low': [top_k, n_units], the fraction of the gate values below saturation[0]
+            'sat_high': [top_k, n_units], the fraction of the gate values above saturation[1]
+            'freqs': [top_k,] frequency of each of the top_k words,
+            'words': [top_k,], a list of words,
+            'units': a dict of the same statistics of each unit over all the words, each is of shape [n_units]
+        }
+    """
+    top = 100 if top_k <= 100 else 500 if top_k <= 500 else 1000
+    tmp_file = get_path(_tmp_dir, '-'.join([data_name, model_name, gate_name, 'statistics', _layer_tag([layer]),
+                                            str(top), str(saturation[0]), str(saturation[1])]))
+
+    def cal_fn():
+        id_to_gates = load_sorted_words_states(data_name, model_name, gate_name, diff=False, layers=layer)
+        words = get_datasets_by_name(data_name, ['id_to_word'])['id_to_word'][:top]
+        stats = cal_grouped_statistics(id_to_gates, range(min(top, len(id_to_gates))), saturation=saturation)
+        stats = {field: value[:, 0] for field, value in stats.items()}
+        stats['freqs'] = id_to_gates.freqs[:top]
+        gates = SortedStates(id_to_gates.states, np.array([0, len(id_to_gates.states)]))
+        unit_stats = cal_grouped_statistics(gates, [0], saturation=saturation)
+        unit_stats = {field: value[0, 0] for field, value in unit_stats.items()}
+        return stats, words, unit_stats
+
+    stats, words, unit_stats = maybe_calculate(tmp_file, cal_fn)
+    results = defaultdict(list)
+    for i in range(len(stats['freqs'])):
+        if len(results['freqs']) == top_k:
+            break
+        if stats['freqs'][i] == 0:
+            continue
+        for key, value in stats.items():
+            results[key].append(value[i].tolist())
+        results['words'].append(words[i])
+    results['units'] = {key: value.tolist() for key, value in unit_stats.items()}
+    return results
+
+
+@memory_cached
 def get_co_cluster(data_name, model_name, state_name, n_clusters, layer=-1, top_k=100,
                    mode='positive', seed=0, method='cocluster'):
     """
@@ -308,10 +919,74 @@ def get_co_cluster(data_name, model_name, state_name, n_clusters, layer=-1, top_
     :param top_k:
     :param mode: 'positive' or 'negative' or 'abs'
     :param seed: random seed
-    :param method: 'cocluster' or 'bicluster'
+    :param method: 'cocluster', 'bicluster', or 'minibatch',
+        'minibatch' co-clusters the words and units with mini-batch k-means, which has no limit on top_k,
+        and uses the whole vocabulary if top_k is None
     :return:
     """
-    strength_list = get_empirical_strength(data_name, model_name, state_name, layer, top_k)
+    if method == 'minibatch':
+        raw_data, data, word_ids = _strength_matrix(data_name, model_name, state_name, layer, top_k, mode,
+                                                    full=True)
+        row_labels, col_labels = minibatch_co_cluster(data, n_clusters, seed)
+        return raw_data, row_labels, col_labels, word_ids
+    if method == 'cocluster':
+        # the normalized SVD is shared by the co-clusterings of all the n_clusters and seeds
+        raw_data, word_ids, row_vecs, col_vecs = get_co_cluster_embedding(data_name, model_name, state_name,
+                                                                          layer, top_k, mode)
+        row_labels, col_labels = co_cluster_from_embedding(row_vecs, col_vecs, n_clusters, seed)
+        return raw_data, row_labels, col_labels, word_ids
+    raw_data, data, word_ids = _strength_matrix(data_name, model_name, state_name, layer, top_k, mode)
+    n_jobs = 1  # parallel num
+    random_state = seed
+    if method == 'bicluster':
+        row_labels, col_labels = spectral_bi_cluster(data, n_clusters, n_jobs, random_state)
+    else:
+        raise ValueError('Unknown method type {:s}, should be cocluster or bicluster!'.format(method))
+    return raw_data, row_labels, col_labels, word_ids
+
+
+@memory_cached
+def get_co_clusters(data_name, model_name, state_name, n_clusters_list, layer=-1, top_k=100,
+                    mode='positive', seeds=(0,), workers=None):
+    """
+    Spectral co-clustering with a batch of n_clusters and seeds, the k-means steps are run in parallel threads
+    :param n_clusters_list: a list of n_clusters
+    :param seeds: a list of random seeds
+    :param workers: the number of threads, default to the number of cpus
+    :return: a tuple (raw_data, word_ids, labels),
+        where labels is a dict {(n_clusters, seed): (row_labels, col_labels)}
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    raw_data, word_ids, row_vecs, col_vecs = get_co_cluster_embedding(data_name, model_name, state_name,
+                                                                      layer, top_k, mode)
+    keys = [(n_clusters, seed) for n_clusters in n_clusters_list for seed in seeds]
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count() or 1) as executor:
+        results = executor.map(lambda key: co_cluster_from_embedding(row_vecs, col_vecs, *key), keys)
+        labels = dict(zip(keys, results))
+    return raw_data, word_ids, labels
+
+
+@memory_cached
+def get_co_cluster_embedding(data_name, model_name, state_name, layer=-1, top_k=100, mode='positive'):
+    """
+    Compute the strength matrix of words and units, and its normalized SVD used by spectral co-clustering
+    :return: a tuple (raw_data, word_ids, row_vecs, col_vecs), see spectral_embedding
+    """
+    raw_data, data, word_ids = _strength_matrix(data_name, model_name, state_name, layer, top_k, mode)
+    row_vecs, col_vecs = spectral_embedding(data)
+    return raw_data, word_ids, row_vecs, col_vecs
+
+
+def _strength_matrix(data_name, model_name, state_name, layer, top_k, mode, full=False):
+    """
+    :param full: if True, take the strength from get_vocab_strength, which is not limited to the top 1000 words
+    :return: a tuple (raw_data, data, word_ids), raw_data is the strength matrix of the words with any
+        non-zero strength, data is raw_data transformed according to the mode
+    """
+    if full:
+        strength_list = get_vocab_strength(data_name, model_name, state_name, layer)[:top_k]
+    else:
+        strength_list = get_empirical_strength(data_name, model_name, state_name, layer, top_k)
     strength_list = [strength_mat.reshape(-1) for strength_mat in strength_list]
     word_ids = []
     raw_data = []
@@ -333,40 +1008,316 @@ def get_co_cluster(data_name, model_name, state_name, n_clusters, layer=-1, top_
         data = raw_data
     else:
         raise ValueError("Unkown mode '{:s}'".format(mode))
-    # print(data)
-    n_jobs = 1  # parallel num
-    random_state = seed
-    if method == 'cocluster':
-        row_labels, col_labels = spectral_co_cluster(data, n_clusters, n_jobs, random_state)
-    elif method == 'bicluster':
-        row_labels, col_labels = spectral_bi_cluster(data, n_clusters, n_jobs, random_state)
+    return raw_data, data, word_ids
+
+
+@memory_cached
+def get_unit_contexts_index(data_name, model_name, state_name, diff=False, top_k=50, chunk_size=10000):
+    """
+    Build an index of the top_k positive and top_k negative activations of each unit, with the (eval, position)
+        keys of the activations, in one streaming pass over the eval records. The index is cached on disk.
+    :param diff: index the state differences instead of the raw states
+    :param top_k: the number of activations to keep for each unit and each sign
+    :param chunk_size: the number of records (from several evals) merged into the index at a time
+    :return: a dict {'eval_ids', 'values', 'evals', 'positions'}, 'eval_ids' is a list of str,
+        the others are ndarrays of shape [2, n_layers, n_units, top_k], the first axis is (positive, negative),
+        sorted by the magnitude of the values, 'evals' are indices into 'eval_ids', -1 when not filled
+    """
+    tmp_file = get_path(_tmp_dir, '-'.join([data_name, model_name, 'contexts', state_name, str(top_k)])
+                        + ('-diff' if diff else ''))
+
+    def cal_fn():
+        eval_ids = []
+        index = None
+        states_shape = None
+        buffer_states, buffer_keys = [], []
+        for eval_id, _, states in iter_eval_states(data_name, model_name, state_name, diff):
+            states_shape = states.shape[1:]
+            buffer_states.append(states.reshape(len(states), -1))
+            buffer_keys.append(np.stack([np.full(len(states), len(eval_ids)), np.arange(len(states))], axis=1))
+            eval_ids.append(eval_id)
+            if sum(len(states) for states in buffer_states) >= chunk_size:
+                index = merge_top_k(index, np.concatenate(buffer_states), np.concatenate(buffer_keys), top_k)
+                buffer_states, buffer_keys = [], []
+        if buffer_states:
+            index = merge_top_k(index, np.concatenate(buffer_states), np.concatenate(buffer_keys), top_k)
+        values, keys = index
+        order = np.argsort(-values, axis=2)
+        signs, features = np.ogrid[:2, :values.shape[1]]
+        values = values[signs[..., None], features[..., None], order]
+        keys = keys[signs[..., None], features[..., None], order]
+        # pad the units seen in fewer than top_k records
+        pad = top_k - values.shape[2]
+        values = np.pad(values, ((0, 0), (0, 0), (0, pad)), 'constant', constant_values=-np.inf)
+        keys = np.pad(keys, ((0, 0), (0, 0), (0, pad), (0, 0)), 'constant', constant_values=-1)
+        values[1] = -values[1]
+        shape = (2,) + states_shape + (top_k,)
+        return {'eval_ids': eval_ids, 'values': values.reshape(shape).astype(np.float32),
+                'evals': keys[..., 0].reshape(shape).astype(np.int32),
+                'positions': keys[..., 1].reshape(shape).astype(np.int32)}
+
+    return maybe_calculate(tmp_file, cal_fn)
+
+
+def merge_top_k(index, values, keys, k):
+    """
+    Merge a chunk of records into the top k positive and top k negative values of each feature,
+        which works like a bounded heap for every feature, but merges a whole chunk at a time.
+    :param index: a pair (top_values, top_keys) returned by the last call, or None
+    :param values: an ndarray of shape [n_records, n_features]
+    :param keys: an ndarray of shape [n_records, key_size], the keys of the records
+    :param k: the number of values to keep
+    :return: a pair (top_values, top_keys), top_values is of shape [2, n_features, <=k],
+        the negative values are negated, top_keys is an int32 ndarray of shape [2, n_features, <=k, key_size],
+        both unsorted
+    """
+    # the negative values are kept as the largest of the negated values
+    candidates = np.stack([values.T, -values.T])
+    n_kept = 0
+    if index is not None:
+        n_kept = index[0].shape[2]
+        candidates = np.concatenate([index[0], candidates], axis=2)
+    n_candidates = candidates.shape[2]
+    if n_candidates > k:
+        # the indices of the winners among the kept ones followed by the records of the chunk
+        top = np.argpartition(candidates, n_candidates - k, axis=2)[..., n_candidates - k:]
     else:
-        raise ValueError('Unknown method type {:s}, should be cocluster or bicluster!'.format(method))
-    return raw_data, row_labels, col_labels, word_ids
+        top = np.broadcast_to(np.arange(n_candidates), candidates.shape)
+    signs, features = np.ogrid[:2, :candidates.shape[1]]
+    signs, features = signs[..., None], features[..., None]
+    # only the keys of the winners are gathered
+    top_keys = keys[np.maximum(top - n_kept, 0)].astype(np.int32)
+    if n_kept:
+        kept = top < n_kept
+        top_keys[kept] = index[1][signs, features, np.minimum(top, n_kept - 1)][kept]
+    return candidates[signs, features, top], top_keys
+
+
+def get_unit_contexts(data_name, model_name, state_name, layer, unit, k=10, window=5, diff=False):
+    """
+    Get the contexts that activate a unit most, see get_unit_contexts_index
+    :param layer: the layer of the unit
+    :param unit: the index of the unit in the layer
+    :param k: the number of contexts of each sign, should be no larger than 50
+    :param window: the number of the surrounding tokens on each side of the activating token
+    :return: a dict {'positive': contexts, 'negative': contexts}, each is a list of dicts
+        {'value', 'eval_id', 'position', 'word_id', 'context', 'offset'}, 'context' is a list of word ids
+        around the token, and 'offset' is the index of the token in 'context'
+    """
+    index = get_unit_contexts_index(data_name, model_name, state_name, diff)
+    values = index['values'][:, layer, unit, :k]
+    evals = index['evals'][:, layer, unit, :k]
+    positions = index['positions'][:, layer, unit, :k]
+    results = {}
+    for sign, name in enumerate(['positive', 'negative']):
+        filled = evals[sign] >= 0
+        contexts = eval_contexts(index['eval_ids'], evals[sign][filled], positions[sign][filled], window)
+        for context, value in zip(contexts, values[sign][filled].tolist()):
+            context['value'] = value
+        results[name] = contexts
+    return results
 
 
-@lru_cache(maxsize=32)
-def get_pos_statistics(data_name, model_name, top_k=500):
-    top = 100 if top_k <= 100 else 500 if top_k <= 500 else 1000
+def eval_contexts(eval_ids, evals, positions, window=5):
+    """
+    Get the surrounding tokens of a batch of recorded tokens
+    :param eval_ids: a list of eval ids
+    :param evals: the indices into eval_ids of the tokens
+    :param positions: the positions of the tokens in the evals
+    :param window: the number of the surrounding tokens on each side
+    :return: a list of dicts {'eval_id', 'position', 'word_id', 'context', 'offset'}, 'context' is a list of
+        word ids around the token, and 'offset' is the index of the token in 'context'
+    """
+    evals = [eval_ids[i] for i in np.asarray(evals).tolist()]
+    eval_data = query_eval_data(list(set(evals)))
+    contexts = []
+    for eval_id, position in zip(evals, np.asarray(positions).tolist()):
+        data = eval_data.get(eval_id, [])
+        start = max(0, position - window)
+        contexts.append({'eval_id': eval_id, 'position': position,
+                         'word_id': data[position] if position < len(data) else None,
+                         'context': data[start:position+window+1], 'offset': position - start})
+    return contexts
+
+
+@memory_cached
+def get_state_index(data_name, model_name, state_name, layer=-1, dim=64, n_lists=None, seed=0):
+    """
+    Build an approximate nearest neighbor index (IVF over PCA-reduced states) of the raw states of a layer,
+        the index is cached on disk. It takes two passes over the records in db,
+        the first one accumulates the covariance for PCA, and the second one reduces and keys the states.
+        The reduced states are partitioned into n_lists inverted lists by k-means.
+    :param layer: the layer of the states
+    :param dim: the dimension of the reduced states
+    :param n_lists: the number of inverted lists, default to sqrt(n_states)
+    :param seed: the random seed of k-means
+    :return: a dict {'eval_ids', 'mean', 'components', 'centroids', 'offsets', 'vectors', 'keys'},
+        the vectors and keys (eval index, position) of the i-th list are in offsets[i]:offsets[i+1]
+    """
+    from sklearn.cluster import MiniBatchKMeans
+    tmp_file = get_path(_tmp_dir, '-'.join([data_name, model_name, 'ann', state_name, str(layer), str(dim),
+                                            str(n_lists), str(seed)]))
 
-    tmp_file = '-'.join([data_name, model_name, 'pos_ratio', str(top)]) + '.pkl'
-    tmp_file = get_path(_tmp_dir, tmp_file)
+    def cal_fn():
+        n = 0
+        total = 0
+        gram = 0
+        for _, _, states in iter_eval_states(data_name, model_name, state_name, False, [layer]):
+            states = states[:, 0].astype(np.float64)
+            n += len(states)
+            total = total + np.sum(states, axis=0)
+            gram = gram + np.dot(states.T, states)
+        mean = total / n
+        _, vecs = np.linalg.eigh(gram / n - np.outer(mean, mean))
+        components = vecs[:, ::-1][:, :dim]
+        eval_ids = []
+        vectors = []
+        keys = []
+        for eval_id, _, states in iter_eval_states(data_name, model_name, state_name, False, [layer]):
+            vectors.append(np.dot(states[:, 0] - mean, components).astype(np.float32))
+            keys.append(np.stack([np.full(len(states), len(eval_ids)), np.arange(len(states))], axis=1))
+            eval_ids.append(eval_id)
+        vectors = np.concatenate(vectors)
+        keys = np.concatenate(keys).astype(np.int32)
+        lists = n_lists or max(1, int(np.sqrt(len(vectors))))
+        kmeans = MiniBatchKMeans(lists, batch_size=max(1000, 3 * lists), random_state=seed).fit(vectors)
+        order = np.argsort(kmeans.labels_, kind='mergesort')
+        offsets = np.concatenate([[0], np.cumsum(np.bincount(kmeans.labels_, minlength=lists))])
+        return {'eval_ids': eval_ids, 'mean': mean, 'components': components,
+                'centroids': kmeans.cluster_centers_.astype(np.float32), 'offsets': offsets,
+                'vectors': vectors[order], 'keys': keys[order]}
+
+    return maybe_calculate(tmp_file, cal_fn)
+
+
+def search_similar_states(data_name, model_name, state_name, layer, state, k=10, n_probe=8, window=5):
+    """
+    Search the recorded states that are most similar to a given state (e.g., a state in the results of
+        /models/evaluate) with the index built by get_state_index
+    :param layer: the layer of the state
+    :param state: an array of shape [n_units], the raw state of the layer
+    :param k: the number of similar states to return
+    :param n_probe: the number of inverted lists to search, larger is more accurate but slower
+    :param window: the number of the surrounding tokens of each state to return
+    :return: a list of dicts {'distance', 'eval_id', 'position', 'word_id', 'context', 'offset'},
+        from the most similar one, where distance is the euclidean distance in the reduced space
+    """
+    index = get_state_index(data_name, model_name, state_name, layer)
+    query = np.dot(np.asarray(state, dtype=np.float64) - index['mean'], index['components'])
+    offsets = index['offsets']
+    probes = np.argsort(np.sum(np.square(index['centroids'] - query), axis=1))[:n_probe]
+    candidates = np.concatenate([np.arange(offsets[i], offsets[i+1]) for i in probes])
+    distances = np.sqrt(np.sum(np.square(index['vectors'][candidates] - query), axis=1))
+    top = np.argsort(distances)[:k]
+    keys = index['keys'][candidates[top]]
+    contexts = eval_contexts(index['eval_ids'], keys[:, 0], keys[:, 1], window)
+    for context, distance in zip(contexts, distances[top].tolist()):
+        context['distance'] = distance
+    return contexts
+
+
+@memory_cached
+def get_unit_histograms(data_name, model_name, state_name, diff=True, n_bins=50, value_range=None):
+    """
+    Calculate the histogram of the values of every unit in one pass over the states,
+        the results are cached on disk.
+    :param diff: use the state differences instead of the raw states
+    :param n_bins: the number of bins
+    :param value_range: the histograms have fixed bins evenly spaced in [-value_range, value_range],
+        the values out of the range are counted in the first or the last bin,
+        default to 1 for the bounded states, 5 for the cell states, and doubled for the differences
+    :return: a dict {'edges', 'counts'}, 'edges' is an ndarray of shape [n_bins+1],
+        'counts' is an int ndarray of shape [n_layers, n_units, n_bins]
+    """
+    if value_range is None:
+        value_range = (5.0 if state_name == 'state_c' else 1.0) * (2 if diff else 1)
+    tmp_file = get_path(_tmp_dir, '-'.join([data_name, model_name, 'histograms', state_name, str(n_bins),
+                                            str(value_range)]) + ('-diff' if diff else ''))
+
+    def cal_fn():
+        edges = np.linspace(-value_range, value_range, n_bins + 1)
+        counts = None
+        for _, states in iter_states(data_name, model_name, state_name, diff):
+            chunk_counts = cal_histograms(states, edges)
+            counts = chunk_counts if counts is None else counts + chunk_counts
+        return {'edges': edges, 'counts': counts}
+
+    return maybe_calculate(tmp_file, cal_fn)
+
+
+def cal_histograms(states, edges):
+    """
+    Count the values of each unit into fixed bins, histograms of the same edges can be merged by addition
+    :param states: an ndarray of shape [n_states, ...]
+    :param edges: the evenly spaced edges of the bins, values out of the edges are counted in the end bins
+    :return: an int ndarray of shape states.shape[1:] + [len(edges) - 1]
+    """
+    n_bins = len(edges) - 1
+    shape = states.shape[1:]
+    states = states.reshape(len(states), -1)
+    bins = np.floor((states - edges[0]) / (edges[-1] - edges[0]) * n_bins)
+    bins = np.clip(bins, 0, n_bins - 1).astype(np.int64)
+    # offset the bins of each unit so that all the units are counted by a single bincount
+    bins += np.arange(states.shape[1]) * n_bins
+    counts = np.bincount(bins.reshape(-1), minlength=states.shape[1] * n_bins)
+    return counts.reshape(shape + (n_bins,))
+
+
+def get_unit_moments(data_name, model_name, state_name, diff=True, layers=-1):
+    """
+    Accumulate the sufficient statistics of the units of the layers in one streaming pass over token chunks,
+        the results are cached on disk.
+    :param layers: a layer or a list of layers, the units of all the layers are the features, in order
+    :return: a dict {'n', 'sum', 'gram'}, see accumulate_moments
+    """
+    layers = _as_list(layers)
+    tmp_file = get_path(_tmp_dir, '-'.join([data_name, model_name, 'moments', state_name, _layer_tag(layers)])
+                        + ('-diff' if diff else ''))
+
+    def cal_fn():
+        moments = None
+        for _, states in iter_states(data_name, model_name, state_name, diff, layers):
+            moments = accumulate_moments(moments, states.reshape(len(states), -1))
+        return moments
+
+    return maybe_calculate(tmp_file, cal_fn)
+
+
+@memory_cached
+def get_unit_similarity(data_name, model_name, state_name, layers=-1, metric='correlation', diff=True):
+    """
+    The similarity matrix of the units, which can span several layers
+    :param layers: a layer or a list of layers, e.g., [0, 1], then the matrix is of 2 x 2 blocks,
+        and the off-diagonal blocks are the similarities between the units of layer 0 and layer 1
+    :param metric: 'correlation', 'cosine' or 'covariance'
+    :return: an ndarray of shape [n_units * len(layers), n_units * len(layers)]
+    """
+    moments = get_unit_moments(data_name, model_name, state_name, diff, layers)
+    return similarity_from_moments(moments, metric).astype(np.float32)
+
+
+@memory_cached
+def get_pos_statistics(data_name, model_name):
+    """
+    Get the ratios of the POS tags of every word, the results are cached on disk
+    :return: a float ndarray of shape [n_words, n_tags], the tags are in the order of pos_tag_list,
+        the rows of the words never seen are zeros
+    """
+    tmp_file = get_path(_tmp_dir, '-'.join([data_name, model_name, 'pos_ratio', 'all']))
 
     def cal_fn():
         word_ids, tags = load_words_and_state(data_name, model_name, 'pos', diff=False)
-        ids_tags = sort_by_id(word_ids, tags)
-        tags_counters = []
-        for i, tags in enumerate(ids_tags):
-            if tags is None:
-                continue
-            counter = Counter(tags)
-            total = len(tags)
-            for key, count in counter.items():
-                counter[key] = count / total
-            tags_counters.append({'id': i, 'ratio': counter})
-        return tags_counters
+        tags = np.asarray(tags)
+        if tags.dtype.kind in 'US':  # the tags recorded as str by old versions
+            unique_tags, inverse = np.unique(tags, return_inverse=True)
+            tags = np.array([pos_tag_code(tag) for tag in unique_tags.tolist()], dtype=np.int64)[inverse]
+        word_ids = np.asarray(word_ids, dtype=np.int64)
+        n_tags = len(pos_tag_list)
+        counts = np.bincount(word_ids * n_tags + tags.astype(np.int64), minlength=(word_ids.max() + 1) * n_tags)
+        counts = counts.reshape(-1, n_tags)
+        return counts / np.maximum(np.sum(counts, axis=1, keepdims=True), 1)
 
-    return maybe_calculate(tmp_file, cal_fn)[:top_k]
+    return maybe_calculate(tmp_file, cal_fn)
 
 
 
@@ -377,26 +1328,117 @@ def get_pos_statistics(data_name, model_name, top_k=500):
 
 def maybe_calculate(filename, cal_fn, *args, **kwargs):
     """
-    Check whether a cached .pkl file exists.
+    Check whether a cached file exists.
     If exists, directly load the file and return,
-    Else, call the `cal_fn`, dump the results to .pkl file specified by `filename`, and return the results.
+    Else, call the `cal_fn`, dump the results to the file specified by `filename`, and return the results.
+    If `filename` ends with .pkl, the results are pickled,
+    else the results are dumped as .npy arrays with a json sidecar (see io_utils.dump_arrays),
+    and later loaded as read-only memory maps.
+    Concurrent calls with the same `filename` only call `cal_fn` once, and the file is written atomically.
     :param filename: the name of the target cached file
     :param cal_fn: a function that maybe called with `*args` and `**kwargs` if no cached file is found.
-    :return: the pickle dumped object, if cache file exists, else return the return value of cal_fn
+    :return: the dumped object, if cache file exists, else return the return value of cal_fn
     """
-    if file_exists(filename):
-        with open(filename, 'rb') as f:
-            results = pickle.loads(f.read())
-    else:
+    return single_flight.do(filename, _load_or_calculate, filename, cal_fn, *args, **kwargs)
+
+
+def _load_or_calculate(filename, cal_fn, *args, **kwargs):
+    if filename.endswith('.pkl'):
+        if file_exists(filename):
+            with open(filename, 'rb') as f:
+                return pickle.loads(f.read())
         results = cal_fn(*args, **kwargs)
-        before_save(filename)
-        with open(filename, 'wb') as f:
-            pickle.dump(results, f)
+        atomic_dump(results, filename, pickle.dump)
+        return results
+    if arrays_exist(filename):
+        return load_arrays(filename)
+    results = cal_fn(*args, **kwargs)
+    dump_arrays(results, filename)
     return results
 
 
-def fetch_state_of_eval(eval_id, field_name='state_c', diff=True):
-    records = query_evaluation_records(eval_id)
+def _as_list(layers):
+    return list(layers) if isinstance(layers, (list, tuple)) else [layers]
+
+
+def _layer_tag(layers):
+    return 'l' + '_'.join([str(l) for l in layers])
+
+
+def _states_file(data_name, model_name, state_name, diff, layer=None, sorted_=False):
+    names = [data_name, model_name, 'words', state_name]
+    if layer is not None:
+        names.append(_layer_tag([layer]))
+    if sorted_:
+        names.append('sorted')
+    return get_path(_tmp_dir, '-'.join(names) + ('-diff' if diff else ''))
+
+
+def iter_states(data_name, model_name, state_name, diff=True, layers=None, chunk_size=10000):
+    """
+    Iterate over the recorded states chunk by chunk, without holding all the states in memory.
+    If the states (or the needed layers) are already cached on disk by load_words_and_state,
+        the chunks are read from the memory map, else the records are fetched from db eval by eval,
+        with only the needed field and layers.
+    :param data_name:
+    :param model_name:
+    :param state_name:
+    :param diff:
+    :param layers: a list of layers to read, if None, read all the layers
+    :param chunk_size: the size of the chunks read from the cache file
+    :return: a generator of (word_ids, states) pairs, states is an ndarray of shape [chunk, len(layers), n_units]
+    """
+    states_file = _states_file(data_name, model_name, state_name, diff)
+    layer_files = [] if layers is None else [_states_file(data_name, model_name, state_name, diff, l) for l in layers]
+    if arrays_exist(states_file):
+        words, states = load_arrays(states_file)
+
+        def take(start, end):
+            chunk = states[start:end]
+            return np.array(chunk if layers is None else chunk[:, layers])
+    elif layer_files and all(arrays_exist(layer_file) for layer_file in layer_files):
+        layer_states = [load_arrays(layer_file) for layer_file in layer_files]
+        words = layer_states[0][0]
+
+        def take(start, end):
+            return np.stack([states[start:end] for _, states in layer_states], axis=1)
+    else:
+        take = None
+    if take is not None:
+        for i in range(0, len(words), chunk_size):
+            yield np.array(words[i:i+chunk_size]), take(i, i+chunk_size)
+        return
+    for _, word_ids, states in iter_eval_states(data_name, model_name, state_name, diff, layers):
+        yield np.array(word_ids), states
+
+
+def iter_eval_states(data_name, model_name, state_name, diff=True, layers=None):
+    """
+    Iterate over the recorded evals in db one by one, with only the needed field and layers
+    :param layers: a list of layers to keep, if None, keep all the layers
+    :return: a generator of (eval_id, word_ids, states) triples, eval_id is a str,
+        states is an ndarray of shape [n_records, n_layers, n_units]
+    """
+    evals = query_evals(data_name, model_name)
+    if evals.count() == 0:
+        raise LookupError("No eval records with data_name: {:s} and model_name: {:s}".format(data_name, model_name))
+    for eval in evals:
+        word_ids, states = fetch_state_of_eval(eval['_id'], state_name, diff, layers)
+        if len(word_ids):
+            yield str(eval['_id']), word_ids, np.stack(states)
+
+
+def fetch_state_of_eval(eval_id, field_name='state_c', diff=True, layers=None):
+    """
+    Fetch the word_ids and states of the records of an eval
+    :param eval_id:
+    :param field_name: the name of the desired state, can be a list of fields
+    :param diff: True if you want the diff, should also be list when field_name is a list
+    :param layers: a list of layers to keep, if None, keep all the layers
+    :return: a pair (word_ids, states)
+    """
+    fields = field_name if isinstance(field_name, list) else [field_name]
+    records = query_evaluation_records(eval_id, fields=['word_id'] + fields)
     word_ids = [record['word_id'] for record in records]
     if isinstance(field_name, list):
         assert isinstance(diff, list)
@@ -405,7 +1447,7 @@ def fetch_state_of_eval(eval_id, field_name='state_c', diff=True):
         diff = [diff]
     states = []
     for i, field in enumerate(field_name):
-        state = [record[field] for record in records]
+        state = [record[field] if layers is None else record[field][layers] for record in records]
         if diff[i]:
             state = [state[0]] + cal_diff(state)
         states.append(state)
@@ -414,13 +1456,14 @@ def fetch_state_of_eval(eval_id, field_name='state_c', diff=True):
     return word_ids, states
 
 
-def fetch_states(data_name, model_name, field_name='state_c', diff=True):
+def fetch_states(data_name, model_name, field_name='state_c', diff=True, layers=None):
     """
     Fetch the word_ids and states of the eval records by data_name and model_name from db
     :param data_name:
     :param model_name:
     :param field_name: the name of the desired state, can be a list of fields
     :param diff: True if you want the diff, should also be list when field_name is a list
+    :param layers: a list of layers to keep, if None, keep all the layers
     :return: a pair (word_id, states)
     """
     evals = query_evals(data_name, model_name)
@@ -429,12 +1472,47 @@ def fetch_states(data_name, model_name, field_name='state_c', diff=True):
     word_ids = []
     states = []
     for eval in evals:
-        word_ids_, states_ = fetch_state_of_eval(eval['_id'], field_name, diff)
+        word_ids_, states_ = fetch_state_of_eval(eval['_id'], field_name, diff, layers)
         word_ids += word_ids_
         states += states_
     return word_ids, states
 
 
+def reservoir_sample(chunks, sample_size, seed=None):
+    """
+    Uniformly sample items without replacement from a stream of chunks, using reservoir sampling (Algorithm R),
+        vectorized within each chunk. Only the reservoir is held in memory.
+    :param chunks: an iterable of ndarrays, each of shape [chunk_size, ...], the items are along the first axis
+    :param sample_size: the number of items to sample
+    :param seed: the random seed, the same seed and stream always produces the same sample
+    :return: an ndarray of shape [min(sample_size, n_items), ...], in no particular order
+    """
+    rng = np.random.RandomState(seed)
+    reservoir = None
+    n_seen = 0
+    for chunk in chunks:
+        if reservoir is None:
+            reservoir = np.empty((sample_size,) + chunk.shape[1:], chunk.dtype)
+        # fill the reservoir first
+        n_fill = max(0, min(sample_size - n_seen, len(chunk)))
+        reservoir[n_seen:n_seen+n_fill] = chunk[:n_fill]
+        n_seen += n_fill
+        rest = chunk[n_fill:]
+        if len(rest) == 0:
+            continue
+        # the t-th item (0-based) replaces a uniformly chosen slot j in [0, t] if j < sample_size
+        slots = (rng.random_sample(len(rest)) * np.arange(n_seen + 1, n_seen + len(rest) + 1)).astype(np.int64)
+        replaced = np.nonzero(slots < sample_size)[0]
+        # when a slot is replaced more than once in the chunk, the last item wins, as in the sequential algorithm
+        _, last = np.unique(slots[replaced][::-1], return_index=True)
+        replaced = replaced[::-1][last]
+        reservoir[slots[replaced]] = rest[replaced]
+        n_seen += len(rest)
+    if reservoir is None:
+        raise LookupError("No items to sample from!")
+    return reservoir[:min(sample_size, n_seen)]
+
+
 def sort_by_id(word_ids, states):
     max_id = max(word_ids)
     id_to_states = [None] * (max_id+1)
@@ -445,6 +1523,57 @@ def sort_by_id(word_ids, states):
     return id_to_states
 
 
+class SortedStates(object):
+    """
+    A read-only list-like container of states grouped by word ids,
+    backed by a single (maybe memory mapped) array instead of a list of lists of small arrays.
+    id_states[i] returns an ndarray of shape [freq_i, n_layer, n_units], or None if word i is never seen.
+    """
+    def __init__(self, states, offsets):
+        """
+        :param states: an ndarray of shape [n_words, n_layer, n_units], sorted by word ids
+        :param offsets: an int ndarray of shape [max_id+2], states of word i are states[offsets[i]:offsets[i+1]]
+        """
+        self.states = states
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            return [self[i] for i in range(*item.indices(len(self)))]
+        if item < 0:
+            item += len(self)
+        if not 0 <= item < len(self):
+            raise IndexError("word id {:d} out of range".format(item))
+        start, end = self.offsets[item], self.offsets[item+1]
+        return None if start == end else self.states[start:end]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    @property
+    def freqs(self):
+        return np.diff(self.offsets)
+
+
+def sort_states_by_id(word_ids, states):
+    """
+    A vectorized version of sort_by_id
+    :param word_ids: a list or ndarray of word ids
+    :param states: an ndarray of shape [n_words, ...]
+    :return: a pair (sorted_states, offsets), see SortedStates
+    """
+    word_ids = np.asarray(word_ids)
+    order = np.argsort(word_ids, kind='mergesort')
+    counts = np.bincount(word_ids, minlength=word_ids.max()+1)
+    offsets = np.zeros(len(counts)+1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    return states[order], offsets
+
+
 def compute_stats(states, sort_by_mean=True, percent=50):
     layer_num = states[0].shape[0]
     states_layer_wise = []
@@ -478,32 +1607,67 @@ def compute_stats(states, sort_by_mean=True, percent=50):
     return means, stds, errors_l, errors_u, indices
 
 
-def cal_state_statistics(states):
+def cal_grouped_statistics(id_states, ids, percents=(50, 82), saturation=None, chunk_size=2 ** 24):
     """
-    Calculate states statistics with regards to a word
-    :param states: a list of state_mat of size [layer_num, layer_size] (state changes of the same word)
-    :return: a list of length layer_num, each element is a dict of statistics
+    Calculate the statistics of the states of each word. The states of a chunk of words are gathered and sorted
+        in a single call, grouped by the offsets of id_states, and the quantiles of all the words and units
+        are interpolated from the sorted values at once, like np.percentile does.
+    :param id_states: a SortedStates instance
+    :param ids: the ids of the words
+    :param percents: the central ranges of the quantiles, e.g., 50 gives the 25% and 75% quantiles as 'low1', 'high1'
+    :param saturation: an optional pair (low, high), if set, the fractions of the values below low and above high
+        are also computed as 'sat_low' and 'sat_high'
+    :param chunk_size: the max number of values sorted at a time, a single word with more values is sorted alone
+    :return: a dict of statistics 'mean', 'low1', 'high1', ..., 'sort_idx', each is an ndarray of shape
+        [len(ids), n_layer, n_units], zeros are used for the words never seen
     """
-    layer_num = states[0].shape[0]
-    percents = [50, 82]
-    stats = []
-    for layer in range(layer_num):
-        state_list = [state[layer] for state in states]
-        states_mat = np.vstack(state_list)
-        mean = np.mean(states_mat, axis=0)
-        idx = np.argsort(mean)
-        lows = []
-        highs = []
-        for percent in percents:
-            lows.append(np.percentile(states_mat, (100-percent)/2, axis=0))
-            highs.append(np.percentile(states_mat, 50 + percent/2, axis=0))
-        stats.append({'mean': mean,
-                      'low1': lows[0],
-                      'high1': highs[0],
-                      'low2': lows[1],
-                      'high2': highs[1],
-                      'sort_idx': idx
-                      })
+    ids = np.asarray(ids, dtype=np.int64).reshape(-1)
+    state_shape = id_states.states.shape[1:]
+    n_features = int(np.prod(state_shape))
+    quantiles = np.array([q for percent in percents for q in [(100 - percent) / 2, 50 + percent / 2]]) / 100
+    starts = np.asarray(id_states.offsets)[ids]
+    lengths = np.asarray(id_states.offsets)[ids + 1] - starts
+    # some words may be seen in test set, a single zero state is used as placeholder
+    sizes = np.maximum(lengths, 1)
+    stats = defaultdict(list)
+    begin = 0
+    while begin < len(ids):
+        end = begin + max(1, np.searchsorted(np.cumsum(sizes[begin:]) * n_features, chunk_size, side='right'))
+        group_sizes = sizes[begin:end]
+        group_starts = np.cumsum(group_sizes) - group_sizes
+        n = int(np.sum(group_sizes))
+        groups = np.repeat(np.arange(end - begin), group_sizes)
+        rows = starts[begin:end][groups] + np.arange(n) - group_starts[groups]
+        placeholders = (lengths[begin:end] == 0)[groups]
+        rows[placeholders] = 0
+        values = id_states.states[rows].reshape(n, n_features)
+        values[placeholders] = 0
+        stats['mean'].append(np.add.reduceat(values, group_starts, axis=0) / group_sizes[:, None])
+        if saturation is not None:
+            stats['sat_low'].append(np.add.reduceat((values < saturation[0]).astype(np.int64), group_starts, axis=0)
+                                    / group_sizes[:, None])
+            stats['sat_high'].append(np.add.reduceat((values > saturation[1]).astype(np.int64), group_starts, axis=0)
+                                     / group_sizes[:, None])
+        # sort the values of each feature within each group
+        values = values.T
+        if end - begin == 1:
+            values = np.sort(values, axis=1)
+        else:
+            order = np.lexsort((values, np.broadcast_to(groups, values.shape)))
+            values = values[np.arange(n_features)[:, None], order]
+        # the linear interpolation of the quantiles, of shape [n_quantiles, n_groups]
+        positions = quantiles[:, None] * (group_sizes - 1)
+        lows = np.floor(positions).astype(np.int64)
+        highs = np.ceil(positions).astype(np.int64)
+        low_values = values[:, group_starts + lows]
+        high_values = values[:, group_starts + highs]
+        values = low_values + (high_values - low_values) * (positions - lows)
+        for j in range(len(percents)):
+            stats['low{:d}'.format(j + 1)].append(values[:, 2 * j].T)
+            stats['high{:d}'.format(j + 1)].append(values[:, 2 * j + 1].T)
+        begin = end
+    stats = {field: np.concatenate(value).reshape((len(ids),) + state_shape) for field, value in stats.items()}
+    stats['sort_idx'] = np.argsort(stats['mean'], axis=-1)
     return stats
 
 
@@ -526,7 +1690,8 @@ def cal_empirical_strength(id_states, strength_func):
     return strength_list
 
 
-def tsne_project(data, perplexity, init_dim=50, lr=50, max_iter=1000):
+def tsne_project(data, perplexity, init_dim=50, lr=50, max_iter=1000, method='auto', theta=0.5, callback=None,
+                 init=None):
     """
     Do t-SNE projection with given configuration
     :param data: 2D numpy.ndarray of shape [n_data, feature_dim]
@@ -534,21 +1699,96 @@ def tsne_project(data, perplexity, init_dim=50, lr=50, max_iter=1000):
     :param init_dim: in case feature size too large, do PCA to reduce feature dim if needed
     :param lr: learning rate
     :param max_iter: the max iterations to run
+    :param method: 'exact', 'barnes_hut', or 'auto', which uses barnes_hut when n_data > 2000
+    :param theta: the accuracy of the barnes_hut method
+    :param callback: an optional function called with the intermediate solutions, see tsne.TSNE.run
+    :param init: an optional initial solution of shape [n_data, 2] to warm start from
     :return: the best solution in the run
     """
-    _tsne_solver = tsne.TSNE(2, perplexity, lr)
-    _tsne_solver.set_inputs(data, init_dim)
-    _tsne_solver.run(max_iter)
+    if method == 'auto':
+        method = 'barnes_hut' if data.shape[0] > 2000 else 'exact'
+    _tsne_solver = tsne.TSNE(2, perplexity, lr, method, theta)
+    _tsne_solver.set_inputs(data, init_dim, init)
+    _tsne_solver.run(max_iter, callback=callback)
     return _tsne_solver.get_best_solution()
 
 
-def spectral_co_cluster(data, n_clusters, para_jobs=1, random_state=None):
-    from sklearn.cluster.bicluster import SpectralCoclustering
-    model = SpectralCoclustering(n_clusters, random_state=random_state, n_jobs=para_jobs)
-    model.fit(data)
-    row_labels = model.row_labels_
-    col_labels = model.column_labels_
-    return row_labels, col_labels
+def mds_project(data, n_landmarks=300):
+    """
+    Do landmark MDS projection
+    :param data: 2D numpy.ndarray of shape [n_data, feature_dim]
+    :param n_landmarks: the number of landmarks, all the points are landmarks if n_data <= n_landmarks,
+        which is the same as classical MDS
+    :return: the solution of shape [n_data, 2]
+    """
+    solution, _ = mds.landmark_mds(np.asarray(data, dtype=np.float64), 2, n_landmarks)
+    return solution
+
+
+def spectral_embedding(data, n_components=32):
+    """
+    The normalized SVD step of the spectral co-clustering (Dhillon, 2001), as in sklearn's SpectralCoclustering
+    :param data: a non-negative 2D numpy.ndarray
+    :param n_components: the max number of singular vectors to keep (besides the first trivial one),
+        which supports up to 2 ** n_components clusters
+    :return: a pair (row_vecs, col_vecs), the scaled left and right singular vectors
+    """
+    normalized, row_diag, col_diag = _scale_normalize(np.asarray(data, dtype=np.float64))
+    u, _, vt = np.linalg.svd(normalized, full_matrices=False)
+    n = min(n_components + 1, u.shape[1])
+    return row_diag[:, None] * u[:, :n], col_diag[:, None] * vt[:n].T
+
+
+def _scale_normalize(data):
+    with np.errstate(divide='ignore'):
+        row_diag = 1 / np.sqrt(np.sum(data, axis=1))
+        col_diag = 1 / np.sqrt(np.sum(data, axis=0))
+    row_diag[~np.isfinite(row_diag)] = 0
+    col_diag[~np.isfinite(col_diag)] = 0
+    return row_diag[:, None] * data * col_diag, row_diag, col_diag
+
+
+def minibatch_co_cluster(data, n_clusters, random_state=None, batch_size=1000, n_epochs=3):
+    """
+    A scalable variant of the spectral co-clustering: the few leading singular vectors of the normalized matrix
+        are found by a sparse solver instead of a full SVD, and the rows and columns are clustered together by
+        mini-batch k-means streaming over the embedded rows and columns.
+    :param data: a non-negative 2D numpy.ndarray of shape [n_words, n_units]
+    :param n_clusters: the number of co-clusters
+    :param random_state: random seed
+    :param batch_size: the size of the mini-batches
+    :param n_epochs: the passes of mini-batches over the data
+    :return: a pair (row_labels, col_labels)
+    """
+    from scipy.sparse.linalg import svds
+    from sklearn.cluster import MiniBatchKMeans
+    normalized, row_diag, col_diag = _scale_normalize(np.asarray(data, dtype=np.float32))
+    n_sv = min(1 + int(np.ceil(np.log2(n_clusters))), min(data.shape) - 1)
+    u, s, vt = svds(normalized, k=n_sv)
+    order = np.argsort(s)[::-1]
+    z = np.vstack([row_diag[:, None] * u[:, order[1:]], col_diag[:, None] * vt[order[1:]].T])
+    kmeans = MiniBatchKMeans(n_clusters, batch_size=batch_size, random_state=random_state)
+    rng = np.random.RandomState(random_state)
+    for _ in range(n_epochs):
+        perm = rng.permutation(z.shape[0])
+        for i in range(0, len(perm), batch_size):
+            batch = perm[i:i+batch_size]
+            if len(batch) >= n_clusters:
+                kmeans.partial_fit(z[batch])
+    labels = kmeans.predict(z)
+    return labels[:data.shape[0]], labels[data.shape[0]:]
+
+
+def co_cluster_from_embedding(row_vecs, col_vecs, n_clusters, random_state=None):
+    """
+    The k-means step of the spectral co-clustering, see spectral_embedding
+    :return: a pair (row_labels, col_labels)
+    """
+    from sklearn.cluster import KMeans
+    n_sv = 1 + int(np.ceil(np.log2(n_clusters)))
+    z = np.vstack([row_vecs[:, 1:n_sv], col_vecs[:, 1:n_sv]])
+    labels = KMeans(n_clusters, random_state=random_state, n_init=10).fit(z).labels_
+    return labels[:row_vecs.shape[0]], labels[row_vecs.shape[0]:]
 
 
 def spectral_bi_cluster(data, n_clusters, para_jobs=1, random_state=None):
@@ -596,12 +1836,44 @@ def cal_diff(arrays):
     return diff_arrays
 
 
-def cal_similar1(array):
+def accumulate_moments(moments, states):
     """
-    :param array: 2D [n_state, n_words], each row as a states history
-    :return: a matrix of n_state x n_state measuring the similarity
+    Accumulate the sufficient statistics of the features over a chunk of samples,
+        moments of different chunks can also be merged by adding the entries
+    :param moments: a dict {'n', 'sum', 'gram'} returned by the last call, or None
+    :param states: an ndarray of shape [n_samples, n_features]
+    :return: a dict {'n', 'sum', 'gram'}
     """
-    return np.dot(array, array.T)
+    states = np.asarray(states, dtype=np.float64)
+    if moments is None:
+        moments = {'n': 0, 'sum': np.zeros(states.shape[1]), 'gram': np.zeros((states.shape[1], states.shape[1]))}
+    moments['n'] += len(states)
+    moments['sum'] += np.sum(states, axis=0)
+    moments['gram'] += np.dot(states.T, states)
+    return moments
+
+
+def similarity_from_moments(moments, metric='correlation'):
+    """
+    :param moments: a dict {'n', 'sum', 'gram'}, see accumulate_moments
+    :param metric: 'correlation', 'cosine' or 'covariance'
+    :return: a matrix of n_features x n_features, the similarity of constant features is 0
+    """
+    gram = np.asarray(moments['gram'])
+    if metric == 'cosine':
+        matrix = gram
+    elif metric in ('correlation', 'covariance'):
+        mean = np.asarray(moments['sum']) / moments['n']
+        matrix = gram / moments['n'] - np.outer(mean, mean)
+        if metric == 'covariance':
+            return matrix
+    else:
+        raise ValueError("Unknown metric {:s}".format(str(metric)))
+    norms = np.sqrt(np.maximum(np.diag(matrix), 0))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        matrix = matrix / np.outer(norms, norms)
+    matrix[~np.isfinite(matrix)] = 0
+    return matrix
 
 
 def normalize(array):
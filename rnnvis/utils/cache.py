@@ -0,0 +1,236 @@
+"""
+An in-memory cache of function results bounded by the real memory footprint of the results,
+and helpers that deduplicate concurrent computations of the same results
+"""
+
+import os
+import sys
+import threading
+from collections import OrderedDict
+from functools import wraps
+
+import numpy as np
+
+# the default budget can be overwritten by the env var RNNVIS_CACHE_BYTES
+_default_budget = int(os.environ.get('RNNVIS_CACHE_BYTES', 2 * 1024 ** 3))
+
+
+def nbytes_of(obj, _seen=None):
+    """
+    Estimate the memory footprint of an object, ndarrays are counted by their buffer size,
+    containers and plain objects are counted recursively, objects shared in the structure are counted once.
+    :param obj: any object
+    :return: number of bytes
+    """
+    if _seen is None:
+        _seen = set()
+    if id(obj) in _seen:
+        return 0
+    _seen.add(id(obj))
+    if isinstance(obj, np.ndarray):
+        # sys.getsizeof counts the buffer only if the array owns its data, a view costs what its base costs,
+        # and a memory map (the base of np.load(mmap_mode='r') arrays) costs no private memory
+        size = sys.getsizeof(obj)
+        if obj.base is not None:
+            size += nbytes_of(obj.base, _seen)
+        return size
+    size = sys.getsizeof(obj)
+    if isinstance(obj, (str, bytes, int, float, bool)) or obj is None:
+        return size
+    if isinstance(obj, dict):
+        return size + sum(nbytes_of(k, _seen) + nbytes_of(v, _seen) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)) and len(obj) > 0 and type(obj[0]) in (float, int, bool):
+        # a flat list of numbers, e.g. from ndarray.tolist(), is estimated by its first element in O(1),
+        # instead of walking millions of floats
+        return size + len(obj) * sys.getsizeof(obj[0])
+    if isinstance(obj, (list, tuple, set, frozenset)):
+        return size + sum(nbytes_of(e, _seen) for e in obj)
+    if hasattr(obj, '__dict__'):
+        return size + nbytes_of(vars(obj), _seen)
+    return size
+
+
+def _freeze(obj):
+    """Convert lists in the arguments to tuples, so that calls like f(layers=[0, 1]) can be cached"""
+    if isinstance(obj, (list, tuple)):
+        return tuple(_freeze(e) for e in obj)
+    return obj
+
+
+def _contains(frozen, arg):
+    """Check whether arg is in the frozen arguments, including the tuples nested in them"""
+    if isinstance(frozen, tuple):
+        return any(_contains(e, arg) for e in frozen)
+    return type(frozen) == type(arg) and frozen == arg
+
+
+class _Call(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    """
+    Keyed single-flight execution: if a call with the same key is in-flight,
+    later callers wait for it and share its result (or its exception) instead of computing again.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, fn, *args, **kwargs):
+        """
+        Call fn(*args, **kwargs), unless a call with the same key is in-flight
+        :param key: a hashable key identifying the computation
+        :param fn: the function to call
+        :return: the return value of fn
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        try:
+            call.result = fn(*args, **kwargs)
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    def in_flight(self, key):
+        return key in self._calls
+
+
+class MemoryCache(object):
+    """
+    A thread-safe LRU cache with a global byte budget.
+    Entries are evicted in least-recently-used order until the total footprint fits in the budget.
+    """
+
+    def __init__(self, max_bytes=_default_budget):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # key -> (value, nbytes)
+        self._nbytes = 0
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._flights = SingleFlight()
+
+    @property
+    def nbytes(self):
+        return self._nbytes
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key][0]
+            self.misses += 1
+            return default
+
+    def put(self, key, value):
+        """
+        Put a value into the cache. A value larger than the whole budget is not cached.
+        :return: True if the value is cached
+        """
+        size = nbytes_of(value)
+        with self._lock:
+            self._remove(key)
+            if size > self.max_bytes:
+                return False
+            self._entries[key] = (value, size)
+            self._nbytes += size
+            self._shrink()
+            return True
+
+    def set_budget(self, max_bytes):
+        with self._lock:
+            self.max_bytes = max_bytes
+            self._shrink()
+
+    def purge(self, func=None, arg=None):
+        """
+        Explicitly remove entries from the cache
+        :param func: only purge the results of this function (a decorated function or its qualified name)
+        :param arg: only purge the results of calls that take `arg` as one of the arguments, e.g., a model name,
+            also matched inside list or tuple arguments, e.g., a list of model names
+        :return: the number of purged entries
+        """
+        if func is not None and not isinstance(func, str):
+            func = func.__qualname__
+        with self._lock:
+            keys = [key for key in self._entries
+                    if (func is None or key[0] == func)
+                    and (arg is None or _contains(key[1], arg) or _contains(tuple(v for _, v in key[2]), arg))]
+            for key in keys:
+                self._remove(key)
+        return len(keys)
+
+    def stats(self):
+        return {'entries': len(self._entries), 'nbytes': self._nbytes, 'max_bytes': self.max_bytes,
+                'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+    def cached(self, func):
+        """
+        A decorator that works like functools.lru_cache, but stores the results in this cache.
+        Concurrent calls with the same arguments are computed only once.
+        """
+        name = func.__qualname__
+
+        def compute(key, args, kwargs):
+            # the result may be cached while waiting for the lock
+            with self._lock:
+                if key in self._entries:
+                    return self._entries[key][0]
+            result = func(*args, **kwargs)
+            self.put(key, result)
+            return result
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            key = (name, _freeze(args), _freeze(tuple(sorted(kwargs.items()))))
+            with self._lock:
+                if key in self._entries:
+                    return self.get(key)
+                self.misses += 1
+            return self._flights.do(key, compute, key, args, kwargs)
+
+        wrapper.cache = self
+        return wrapper
+
+    def _remove(self, key):
+        if key in self._entries:
+            _, size = self._entries.pop(key)
+            self._nbytes -= size
+
+    def _shrink(self):
+        while self._nbytes > self.max_bytes and self._entries:
+            _, (_, size) = self._entries.popitem(last=False)
+            self._nbytes -= size
+            self.evictions += 1
+
+
+# the single-flight group and the cache shared by the whole backend
+single_flight = SingleFlight()
+memory_cache = MemoryCache()
+memory_cached = memory_cache.cached
@@ -6,10 +6,14 @@ import os
 import json
 import io
 import csv
+import shutil
+import tempfile
 from urllib.request import urlretrieve
 
 from zipfile import ZipFile
 
+import numpy as np
+
 
 base_dir = os.path.abspath(os.path.join(__file__, '../../../'))
 # print('basedir: {:s}'.format(base_dir))
@@ -32,6 +36,27 @@ def get_path(path, file_name=None, absolute=False):
     return os.path.relpath(_p)
 
 
+def atomic_dump(obj, file_path, dump_fn):
+    """
+    Write a file atomically: `dump_fn(obj, f)` writes to a temp file which then replaces `file_path`,
+    so that a concurrent reader never sees a truncated file
+    :param obj: the object to dump
+    :param file_path: the target file path
+    :param dump_fn: a function like pickle.dump
+    :return: None
+    """
+    before_save(file_path)
+    fd, tmp_path = tempfile.mkstemp(prefix=os.path.basename(file_path) + '.', suffix='.tmp',
+                                    dir=os.path.dirname(os.path.abspath(file_path)))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            dump_fn(obj, f)
+        os.replace(tmp_path, file_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
 def write2file(s_io, file_path, mode, encoding=None):
     """
     This is a wrapper function for writing files to disks,
@@ -123,6 +148,95 @@ def before_save(file_or_dir):
         os.makedirs(dir_name)
 
 
+_meta_file = 'meta.json'
+
+
+def _encode_arrays(obj, arrays):
+    """
+    Recursively replace the ndarrays in obj with references to .npy files,
+    the arrays are appended to `arrays`, the returned structure is json serializable
+    """
+    if isinstance(obj, np.ndarray):
+        arrays.append(obj)
+        return {'__npy__': 'arr_{:d}.npy'.format(len(arrays) - 1)}
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if isinstance(obj, dict):
+        return {'__dict__': [[_encode_arrays(k, arrays), _encode_arrays(v, arrays)] for k, v in obj.items()]}
+    if isinstance(obj, tuple):
+        return {'__tuple__': [_encode_arrays(e, arrays) for e in obj]}
+    if isinstance(obj, list):
+        return [_encode_arrays(e, arrays) for e in obj]
+    if obj is None or isinstance(obj, (str, int, float, bool)):
+        return obj
+    raise TypeError("Cannot dump object of type {:s} as arrays".format(str(type(obj))))
+
+
+def _decode_arrays(obj, path, mmap_mode):
+    if isinstance(obj, list):
+        return [_decode_arrays(e, path, mmap_mode) for e in obj]
+    if isinstance(obj, dict):
+        if '__npy__' in obj:
+            return np.load(os.path.join(path, obj['__npy__']), mmap_mode=mmap_mode, allow_pickle=False)
+        if '__tuple__' in obj:
+            return tuple(_decode_arrays(e, path, mmap_mode) for e in obj['__tuple__'])
+        return {_decode_arrays(k, path, mmap_mode): _decode_arrays(v, path, mmap_mode) for k, v in obj['__dict__']}
+    return obj
+
+
+def dump_arrays(obj, path):
+    """
+    Dump an array-heavy object to a dir, each ndarray is saved as a .npy file,
+    and the structure (lists, tuples, dicts and plain values) is saved in a small json sidecar.
+    Different from pickle, the arrays can be loaded with memory map, see load_arrays.
+    The dir is written atomically: the files are written to a temp dir which is then renamed to `path`,
+    so a reader never sees a partially written dir.
+    :param obj: an ndarray, or nested lists / tuples / dicts of ndarrays and plain values
+    :param path: the dir to dump to
+    :return: None
+    """
+    arrays = []
+    meta = _encode_arrays(obj, arrays)
+    before_save(path)
+    tmp_path = tempfile.mkdtemp(prefix=os.path.basename(path) + '.', suffix='.tmp',
+                                dir=os.path.dirname(os.path.abspath(path)))
+    try:
+        for i, array in enumerate(arrays):
+            np.save(os.path.join(tmp_path, 'arr_{:d}.npy'.format(i)), array, allow_pickle=False)
+        # the sidecar is written last, so that an artifact without it is regarded as incomplete
+        with open(os.path.join(tmp_path, _meta_file), 'w') as f:
+            json.dump({'version': 1, 'data': meta}, f)
+        if os.path.isdir(path) and not arrays_exist(path):
+            shutil.rmtree(path, ignore_errors=True)  # left by an interrupted writer
+        try:
+            os.rename(tmp_path, path)
+        except OSError:
+            if not arrays_exist(path):
+                raise
+            # another process has dumped the same object in the meantime, keep it
+    finally:
+        if os.path.isdir(tmp_path):
+            shutil.rmtree(tmp_path, ignore_errors=True)
+
+
+def load_arrays(path, mmap_mode='r'):
+    """
+    Load an object dumped by dump_arrays
+    :param path: the dir of the dumped object
+    :param mmap_mode: the mmap_mode used by np.load, default to 'r', i.e., read-only memory map.
+        Memory mapped arrays are loaded lazily and share the page cache across processes.
+    :return: the dumped object
+    """
+    with open(os.path.join(path, _meta_file)) as f:
+        meta = json.load(f)
+    return _decode_arrays(meta['data'], path, mmap_mode)
+
+
+def arrays_exist(path):
+    """Check whether a complete object dumped by dump_arrays exists"""
+    return file_exists(os.path.join(path, _meta_file))
+
+
 def download(url, path):
     """
     Download zip file from url and extract all the files under path
@@ -0,0 +1,86 @@
+"""
+Tests for the in-memory cache and single-flight helpers
+"""
+
+import time
+import threading
+
+import numpy as np
+
+from rnnvis.utils.cache import MemoryCache, SingleFlight, nbytes_of
+
+
+def test_byte_budget():
+    cache = MemoryCache(max_bytes=3 * 8000)
+
+    @cache.cached
+    def ones(n):
+        return np.ones(n)
+
+    for i in range(5):
+        ones(1000 + i)
+    assert cache.nbytes <= cache.max_bytes
+    assert cache.evictions > 0
+    ones(1004)
+    assert cache.hits == 1
+    assert cache.purge(ones, arg=1004) == 1
+    assert (ones.__qualname__, (1004,), ()) not in cache
+
+
+def test_nbytes_of_views():
+    array = np.ones((100, 100))
+    assert nbytes_of(array) >= array.nbytes
+    # the base of a view should be counted only once
+    assert nbytes_of([array, array[:10]]) < 2 * array.nbytes
+
+
+def test_nbytes_of_lists():
+    array = np.random.RandomState(0).rand(300, 400)
+    nested = array.tolist()
+    # the flat rows are estimated without walking their floats
+    assert nbytes_of(nested) >= array.nbytes
+    # lists of other objects are still walked
+    assert nbytes_of(['a' * 1000, 'b' * 1000]) > 2000
+    assert nbytes_of([]) < nbytes_of([1.0])
+
+
+def test_single_flight():
+    flights = SingleFlight()
+    calls = []
+
+    def slow():
+        calls.append(1)
+        time.sleep(0.1)
+        return len(calls)
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(flights.do('key', slow))) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(calls) == 1
+    assert results == [1] * 4
+
+
+def test_purge_nested_args():
+    cache = MemoryCache()
+
+    @cache.cached
+    def compare(data_name, model_names, layer=-1):
+        return len(model_names)
+
+    compare('ptb', ['LSTM-PTB', 'GRU-PTB'])
+    compare('ptb', ('RNN-PTB',), layer=0)
+    compare('ptb', [], layer='LSTM-PTB')
+    assert cache.purge(arg='GRU-PTB') == 1
+    assert cache.purge(arg='LSTM-PTB') == 1
+    assert cache.purge(arg='layer') == 0
+    assert len(cache) == 1
+
+
+if __name__ == '__main__':
+    test_byte_budget()
+    test_nbytes_of_views()
+    test_single_flight()
+    test_purge_nested_args()
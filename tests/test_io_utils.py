@@ -0,0 +1,41 @@
+"""
+Tests for dumping and loading array-heavy objects
+"""
+
+import os
+
+import numpy as np
+
+from rnnvis.utils.io_utils import dump_arrays, load_arrays, arrays_exist
+
+
+def test_dump_and_load_arrays(tmp_path):
+    path = os.path.join(str(tmp_path), 'artifact')
+    obj = {'states': np.arange(12, dtype=np.float32).reshape(3, 4), 'layers': [0, 1],
+           'pair': (np.ones(2), 'ids'), 1: None, 'scalar': np.float64(0.5)}
+    assert not arrays_exist(path)
+    dump_arrays(obj, path)
+    assert arrays_exist(path)
+    loaded = load_arrays(path)
+    assert isinstance(loaded['states'], np.memmap)
+    assert np.array_equal(loaded['states'], obj['states']) and loaded['states'].dtype == np.float32
+    assert isinstance(loaded['pair'], tuple) and np.array_equal(loaded['pair'][0], np.ones(2))
+    assert loaded['pair'][1] == 'ids' and loaded['layers'] == [0, 1] and loaded[1] is None
+    assert loaded['scalar'] == 0.5
+
+
+def test_dump_arrays_replaces_incomplete(tmp_path):
+    path = os.path.join(str(tmp_path), 'artifact')
+    # an artifact without the sidecar is left by an interrupted writer
+    os.makedirs(path)
+    np.save(os.path.join(path, 'arr_0.npy'), np.ones(3))
+    assert not arrays_exist(path)
+    dump_arrays([np.zeros(3)], path)
+    assert np.array_equal(load_arrays(path, mmap_mode=None)[0], np.zeros(3))
+    # the temp dirs are cleaned up
+    assert os.listdir(str(tmp_path)) == ['artifact']
+
+if __name__ == '__main__':
+    import tempfile
+    test_dump_and_load_arrays(tempfile.mkdtemp())
+    test_dump_arrays_replaces_incomplete(tempfile.mkdtemp())
@@ -0,0 +1,23 @@
+"""
+Tests for the landmark MDS in vendor
+"""
+
+import numpy as np
+from scipy.spatial.distance import pdist
+
+from rnnvis.vendor import mds
+
+
+def test_landmark_mds():
+    rng = np.random.RandomState(0)
+    # points on a 2D plane embedded in 10D
+    X = np.dot(rng.randn(2000, 2) * [5, 2], np.linalg.qr(rng.randn(10, 10))[0][:2])
+    Y, eigs = mds.landmark_mds(X, 2, 100)
+    assert Y.shape == (2000, 2)
+    assert np.allclose(pdist(Y[:200]), pdist(X[:200]), atol=1e-6)
+    # deterministic
+    assert np.array_equal(Y, mds.landmark_mds(X, 2, 100)[0])
+
+
+if __name__ == '__main__':
+    test_landmark_mds()
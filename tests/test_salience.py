@@ -0,0 +1,45 @@
+"""
+Tests for the Jacobian computation used by Evaluator.cal_salience
+"""
+
+import numpy as np
+import tensorflow as tf
+
+from rnnvis.rnn import rnn  # import rnn before evaluator, since they import each other
+from rnnvis.rnn.evaluator import cal_jacobian
+
+
+def sigmoid(x):
+    return 1 / (1 + np.exp(-x))
+
+
+def numerical_jacobian(f, x, delta=1e-6):
+    """Central differences of f w.r.t. each dimension of x, f maps [batch_size, x_len] to [batch_size, y_len]"""
+    x = x.reshape(len(x), -1)
+    columns = []
+    for i in range(x.shape[1]):
+        dx = np.zeros_like(x)
+        dx[:, i] = delta
+        columns.append((f(x + dx) - f(x - dx)) / (2 * delta))
+    return np.stack(columns, axis=2)
+
+
+def test_jacobian():
+    rng = np.random.RandomState(0)
+    batch_size, x_len, y_len = 3, 4, 5
+    W, U = rng.randn(x_len, y_len), rng.randn(x_len, y_len)
+    x_val = rng.randn(batch_size, 1, x_len)
+    # a tiny cell like the output of a LSTM: o * tanh(c)
+    expected = numerical_jacobian(lambda v: sigmoid(np.dot(v, W)) * np.tanh(np.dot(v, U)), x_val)
+    with tf.Graph().as_default():
+        x = tf.placeholder(tf.float64, [batch_size, 1, x_len])
+        h = tf.reshape(x, [batch_size, x_len])
+        y = tf.sigmoid(tf.matmul(h, W)) * tf.tanh(tf.matmul(h, U))
+        with tf.Session():
+            assert np.allclose(cal_jacobian(y, x, x_val), expected, atol=1e-6)
+            assert np.allclose(cal_jacobian(y, x, x_val, y_or_x='x'), np.sum(expected, axis=1), atol=1e-6)
+            assert np.allclose(cal_jacobian(y, x, x_val, y_or_x='y'), np.sum(expected, axis=2), atol=1e-6)
+
+
+if __name__ == '__main__':
+    test_jacobian()
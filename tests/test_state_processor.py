@@ -0,0 +1,226 @@
+"""
+Tests for the numpy helpers in state_processor, the db is replaced by in-memory evals where needed
+"""
+
+from collections import defaultdict
+
+import numpy as np
+
+from rnnvis import state_processor
+from rnnvis.datasets.text_processor import pos_tag_list
+from rnnvis.utils.io_utils import dump_arrays
+
+
+def test_reservoir_sample():
+    items = np.arange(50)
+    counts = np.zeros(50)
+    for seed in range(2000):
+        chunks = [items[:7], items[7:8], items[8:30], items[30:]]
+        sample = state_processor.reservoir_sample(chunks, 10, seed)
+        assert len(np.unique(sample)) == 10
+        counts[sample] += 1
+    # each item is sampled with probability 10 / 50
+    assert np.all(np.abs(counts - 400) < 80)
+    # fewer items than the sample size
+    assert np.array_equal(np.sort(state_processor.reservoir_sample([items[:3], items[3:5]], 10, 0)), items[:5])
+    # the same seed and stream gives the same sample
+    assert np.array_equal(state_processor.reservoir_sample([items[:20], items[20:]], 10, 1),
+                          state_processor.reservoir_sample([items[:20], items[20:]], 10, 1))
+
+
+def test_sentiment_trajectories_with_project(tmp_path, monkeypatch):
+    rng = np.random.RandomState(0)
+    reviews = [[1, 2, 3], [4, 5], [6, 7, 8, 9]]
+    labels = [0, 1, 1]
+    states = {i: rng.randn(len(review), 1, 4) for i, review in enumerate(reviews)}
+    W, b = rng.randn(4, 2), np.zeros(2)
+    monkeypatch.setattr(state_processor, '_tmp_dir', str(tmp_path))
+    monkeypatch.setattr(state_processor, 'get_datasets_by_name',
+                        lambda name, fields: {'test': {'data': reviews, 'label': labels}})
+    monkeypatch.setattr(state_processor, 'query_evals',
+                        lambda *args: [{'_id': i, 'data': review, 'records': review}
+                                       for i, review in enumerate(reviews)])
+    monkeypatch.setattr(state_processor, 'fetch_state_of_eval',
+                        lambda eval_id, fields, diffs: (None, [list(states[eval_id]), list(states[eval_id])]))
+    for _ in range(2):  # the second call is loaded from the disk cache
+        results = state_processor.get_sentiment_trajectories('data', 'model', 'state', 0, 2, [W, b], 'state')
+        predicted = [int(np.argmax(np.dot(states[i][-1, -1], W) + b)) for i in range(3)]
+        assert results['accuracy'] == np.mean(np.array(predicted) == labels)
+        # review 1 is split into buckets of [4] and [5]
+        assert np.allclose(results['gold']['mean'][1, 0], (states[1][0, 0] + states[2][0, 0] + states[2][1, 0]) / 3)
+        assert np.array_equal(results['gold']['counts'], [[2, 1], [3, 3]])
+
+
+def test_load_layer_states(tmp_path, monkeypatch):
+    rng = np.random.RandomState(0)
+    words = [[3, 1, 2], [1, 3]]
+    states = [rng.randn(len(word_ids), 3, 4) for word_ids in words]
+    scanned = []
+
+    def fetch_state_of_eval(eval_id, fields, diffs, layers):
+        assert fields == ['state']
+        scanned.append(layers)
+        return words[eval_id], [state[layers] for state in states[eval_id]]
+
+    monkeypatch.setattr(state_processor, '_tmp_dir', str(tmp_path))
+    monkeypatch.setattr(state_processor, '_recorded_fields', lambda *args: ('state',))
+    monkeypatch.setattr(state_processor, 'query_evals', lambda *args: [{'_id': 0}, {'_id': 1}])
+    monkeypatch.setattr(state_processor, 'fetch_state_of_eval', fetch_state_of_eval)
+    all_words, all_states = np.concatenate(words), np.concatenate(states)
+    word_ids, layer_states = state_processor.load_words_and_state('sliced', 'model', 'state', layers=1)
+    assert np.array_equal(word_ids, all_words)
+    assert np.allclose(layer_states, all_states[:, 1:2])
+    assert scanned == [[1], [1]]
+    # layer 1 is loaded from its disk cache, only layer 2 is fetched
+    word_ids, layer_states = state_processor.load_words_and_state('sliced', 'model', 'state', layers=[1, 2],
+                                                                  units=[0, 2])
+    assert np.allclose(layer_states, all_states[:, 1:3][:, :, [0, 2]])
+    assert scanned == [[1], [1], [2], [2]]
+    # the same arguments are served from the memory cache
+    assert state_processor.load_words_and_state('sliced', 'model', 'state', layers=[1, 2], units=[0, 2])[1] \
+        is layer_states
+    id_states = state_processor.load_sorted_words_states('sliced', 'model', 'state', layers=2, units=[3])
+    assert scanned == [[1], [1], [2], [2]]
+    for id_ in [1, 2, 3]:
+        assert np.allclose(id_states[id_], all_states[all_words == id_][:, 2:3, 3:4])
+
+
+def test_bigram_statistics(tmp_path, monkeypatch):
+    rng = np.random.RandomState(0)
+    lengths = [30, 25, 20]
+    words = rng.randint(0, 5, sum(lengths))
+    states = rng.randn(len(words), 2, 3)
+    monkeypatch.setattr(state_processor, '_tmp_dir', str(tmp_path))
+    monkeypatch.setattr(state_processor, '_load_layer_states',
+                        lambda data_name, model_name, state_name, diff, layer: (words, states[:, layer]))
+    monkeypatch.setattr(state_processor, 'query_evals',
+                        lambda *args: [{'records': [None] * length} for length in lengths])
+    # group the states by the pairs within each eval
+    grouped = defaultdict(list)
+    start = 0
+    for length in lengths:
+        for i in range(start + 1, start + length):
+            grouped[(words[i - 1], words[i])].append(states[i, 1])
+        start += length
+    stats = state_processor.get_bigram_statistics('data', 'model', 'state', layer=1)
+    assert sorted(map(tuple, stats['pairs'].tolist())) == sorted(grouped.keys())
+    assert np.all(np.diff(stats['freqs']) <= 0)
+    for i, pair in enumerate(stats['pairs'].tolist()):
+        values = np.array(grouped[tuple(pair)])
+        assert stats['freqs'][i] == len(values)
+        assert np.allclose(stats['mean'][i], np.mean(values, axis=0))
+        for field, q in [('low1', 25), ('high1', 75), ('low2', 9), ('high2', 91)]:
+            assert np.allclose(stats[field][i], np.percentile(values, q, axis=0))
+    # the top_n pairs are the most frequent ones
+    top = state_processor.get_bigram_statistics('data', 'model', 'state', layer=1, top_n=3)
+    assert np.array_equal(top['pairs'], stats['pairs'][:3])
+    assert np.allclose(top['high2'], stats['high2'][:3])
+
+
+def test_comparative_statistics(monkeypatch):
+    rng = np.random.RandomState(0)
+    words = rng.randint(0, 6, 200)
+    records = {'a': (words, rng.randn(200, 4)), 'b': (words, rng.randn(200, 4)),
+               # evaluated on other records, in which the words 4 and 5 are never seen
+               'c': (rng.randint(0, 4, 150), rng.randn(150, 4))}
+    monkeypatch.setattr(state_processor, '_load_layer_states',
+                        lambda data_name, model_name, state_name, diff, layer: records[model_name])
+    results = state_processor.get_comparative_statistics('comparative', ['a', 'b', 'c'], 'state', top_k=5)
+    assert np.array_equal(results['ids'], np.arange(5))
+    assert np.array_equal(results['freqs'], np.bincount(words)[:5])
+    for name, (model_words, states) in records.items():
+        id_states = state_processor.SortedStates(*state_processor.sort_states_by_id(model_words, states[:, None]))
+        seen = results['ids'][results['ids'] <= np.max(model_words)]
+        expected = state_processor.cal_grouped_statistics(id_states, seen)
+        for field, value in expected.items():
+            assert np.allclose(results['models'][name][field][:len(seen)], value[:, 0])
+            # zeros for the words never seen
+            assert field == 'sort_idx' or np.all(results['models'][name][field][len(seen):] == 0)
+
+
+def test_pos_statistics(tmp_path, monkeypatch):
+    rng = np.random.RandomState(0)
+    word_ids = rng.randint(0, 8, 300)
+    word_ids[word_ids == 4] = 5  # word 4 is never seen
+    codes = rng.randint(0, len(pos_tag_list), 300)
+    # old versions recorded the tags as str, the unknown tags are coded as 'X'
+    str_tags = [pos_tag_list[code] for code in codes]
+    str_tags[0] = 'UNKNOWN'
+    codes[0] = pos_tag_list.index('X')
+    records = {'int': codes, 'str': np.array(str_tags)}
+    expected = np.zeros((8, len(pos_tag_list)))
+    for word_id, code in zip(word_ids, codes):
+        expected[word_id, code] += 1
+    expected /= np.maximum(np.sum(expected, axis=1, keepdims=True), 1)
+    monkeypatch.setattr(state_processor, '_tmp_dir', str(tmp_path))
+    monkeypatch.setattr(state_processor, 'load_words_and_state',
+                        lambda data_name, model_name, state_name, diff: (word_ids, records[data_name]))
+    for data_name in records:
+        ratios = state_processor.get_pos_statistics(data_name, 'model')
+        assert np.allclose(ratios, expected)
+        assert np.all(ratios[4] == 0)
+
+
+def test_merge_top_k():
+    rng = np.random.RandomState(0)
+    values = rng.randn(1000, 7)
+    keys = np.stack([np.arange(1000) // 100, np.arange(1000) % 100], axis=1)
+    index = None
+    for i in range(0, 1000, 300):
+        index = state_processor.merge_top_k(index, values[i:i+300], keys[i:i+300], 20)
+    top_values, top_keys = index
+    assert top_keys.dtype == np.int32
+    for sign, signed_values in enumerate([values, -values]):
+        expected = np.sort(signed_values, axis=0)[-20:]
+        assert np.allclose(np.sort(top_values[sign], axis=1), expected.T)
+        # the keys point to the records of the values
+        records = top_keys[sign, :, :, 0] * 100 + top_keys[sign, :, :, 1]
+        assert np.allclose(signed_values[records, np.arange(7)[:, None]], top_values[sign])
+
+
+def test_get_salience(tmp_path, monkeypatch):
+    monkeypatch.setattr(state_processor, '_tmp_dir', str(tmp_path))
+    for top_k in [100, 1000]:
+        dump_arrays({'checkpoint': 'ckpt', 'fields': {'state': [np.full((top_k, 3), top_k)]}},
+                    state_processor._salience_file('model', 'y', top_k))
+    assert state_processor.get_salience('model', 'y', 5)['fields']['state'][0].shape == (100, 3)
+    assert state_processor.get_salience('model', 'y', 101)['fields']['state'][0].shape == (1000, 3)
+    assert state_processor.get_salience('model', 'y')['fields']['state'][0].shape == (1000, 3)
+    assert state_processor.get_salience('model', 'y', 1001) is None
+    assert state_processor.get_salience('model', 'x') is None
+
+
+def test_histograms():
+    rng = np.random.RandomState(0)
+    states = rng.randn(1000, 2, 3) * 2
+    edges = np.linspace(-3, 3, 13)
+    counts = state_processor.cal_histograms(states, edges)
+    assert counts.shape == (2, 3, 12)
+    for layer in range(2):
+        for unit in range(3):
+            # the values out of the edges are counted in the end bins
+            expected, _ = np.histogram(np.clip(states[:, layer, unit], -3, 3), edges)
+            assert np.array_equal(counts[layer, unit], expected)
+    # the histograms of chunks can be merged by addition
+    merged = state_processor.cal_histograms(states[:300], edges) + state_processor.cal_histograms(states[300:], edges)
+    assert np.array_equal(merged, counts)
+
+
+def test_grouped_statistics():
+    rng = np.random.RandomState(0)
+    word_ids = rng.randint(0, 30, 500)
+    word_ids[word_ids == 3] = 4  # word 3 is never seen
+    states, offsets = state_processor.sort_states_by_id(word_ids, rng.rand(500, 2, 6))
+    id_states = state_processor.SortedStates(states, offsets)
+    ids = [5, 3, 0, 29, 7]
+    # a chunk of one word, a chunk of a few words, and a single chunk
+    for chunk_size in [12, 600, 2 ** 24]:
+        stats = state_processor.cal_grouped_statistics(id_states, ids, saturation=(0.1, 0.9), chunk_size=chunk_size)
+        for i, id_ in enumerate(ids):
+            values = id_states[id_] if id_ != 3 else np.zeros((1, 2, 6))
+            assert np.allclose(stats['mean'][i], np.mean(values, axis=0))
+            for field, q in [('low1', 25), ('high1', 75), ('low2', 9), ('high2', 91)]:
+                assert np.allclose(stats[field][i], np.percentile(values, q, axis=0))
+            assert np.allclose(stats['sat_low'][i], np.mean(values < 0.1, axis=0))
+            assert np.allclose(stats['sat_high'][i], np.mean(values > 0.9, axis=0))
+    assert np.array_equal(stats['sort_idx'], np.argsort(stats['mean'], axis=-1))
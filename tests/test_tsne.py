@@ -0,0 +1,79 @@
+"""
+Tests for the t-SNE solvers in vendor
+"""
+
+import numpy as np
+
+from rnnvis.vendor import tsne
+
+
+def exact_repulsion(Y):
+    diff = Y[:, None, :] - Y[None, :, :]
+    num = 1 / (1 + np.sum(np.square(diff), axis=2))
+    np.fill_diagonal(num, 0)
+    return np.sum(np.square(num)[:, :, None] * diff, axis=1), np.sum(num)
+
+
+def test_bh_repulsion():
+    rng = np.random.RandomState(0)
+    Y = rng.randn(500, 2) * 5
+    rep, Z = exact_repulsion(Y)
+    bh_rep, bh_Z = tsne.bh_repulsion(Y, theta=0.5)
+    assert np.max(np.abs(bh_rep - rep)) < 0.05 * np.max(np.abs(rep))
+    assert abs(bh_Z / Z - 1) < 0.05
+
+
+def test_perplexity_search():
+    rng = np.random.RandomState(0)
+    X = rng.randn(200, 10)
+    P = tsne.x2p(X, perplexity=20.0)
+    assert np.allclose(np.sum(P, axis=1), 1)
+    H = -np.sum(P * np.log(np.maximum(P, 1e-300)), axis=1)
+    assert np.allclose(np.exp(H), 20.0, rtol=1e-3)
+
+
+def test_barnes_hut_separates_clusters():
+    rng = np.random.RandomState(0)
+    X = np.vstack([rng.randn(300, 10) + c for c in [0, 10]])
+    solver = tsne.TSNE(2, 30.0, method='barnes_hut')
+    solver.set_inputs(X, 10)
+    solver.run(300)
+    Y = solver.get_best_solution()
+    centers = np.stack([np.mean(Y[:300], 0), np.mean(Y[300:], 0)])
+    nearest = np.argmin(np.sum(np.square(Y[:, None, :] - centers), axis=2), axis=1)
+    assert np.mean(nearest == np.repeat([0, 1], 300)) > 0.99
+
+
+def test_warm_start():
+    rng = np.random.RandomState(0)
+    X = rng.randn(200, 10)
+    solver = tsne.TSNE(2, 20.0)
+    solver.set_inputs(X, 10)
+    solver.run(300)
+    warm = tsne.TSNE(2, 25.0)
+    warm.set_inputs(X, 10, init_Y=solver.get_best_solution())
+    warm.run(20)
+    assert warm.exaggeration == 1
+    assert warm.best_error < solver.best_error * 1.5
+
+
+def test_pca_methods():
+    rng = np.random.RandomState(0)
+    X = np.dot(rng.randn(300, 10), rng.randn(10, 800)) + 0.01 * rng.randn(300, 800)
+    Y, variance = tsne.pca(X, 10, 'eig')
+    ipca = tsne.IncrementalPCA(300)
+    for i in range(0, 800, 150):
+        ipca.partial_fit(X[:, i:i+150])
+    for Y2, variance2 in [tsne.pca(X, 10, 'randomized'), ipca.transform(10)]:
+        assert abs(variance2 - variance) < 1e-6
+        # the components are the same up to signs
+        cos = np.sum(Y * Y2, 0) / np.linalg.norm(Y, axis=0) / np.linalg.norm(Y2, axis=0)
+        assert np.allclose(np.abs(cos), 1, atol=1e-4)
+
+
+if __name__ == '__main__':
+    test_bh_repulsion()
+    test_perplexity_search()
+    test_barnes_hut_separates_clusters()
+    test_warm_start()
+    test_pca_methods()